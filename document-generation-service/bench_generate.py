@@ -0,0 +1,445 @@
+
+"""
+效能基準 / 回歸檢查: 以合成範本 (章節迴圈、段落、表格列迴圈、圖片) 量測文件生成各階段耗時
+
+每個案例在獨立子行程中執行,記錄 (耗時皆取 repeat 次中最佳值):
+  render_seconds   docxtpl DocxTemplate.render (未使用範本快取的原始流程)
+  save_seconds     DocxTemplate.save
+  service_seconds  render_template_to (服務實際流程,含編譯範本;章節數達門檻時為串流組裝)
+  cached_seconds   同一份範本與資料再生成一次 (範本快取 + 章節快取全部命中)
+  pdf_seconds      LibreOffice 轉檔 (找不到 soffice 或加 --skip-pdf 時不量測)
+  upload_seconds   upload_generated_file 上傳至本地 storage stub
+  peak_rss_mb      子行程峰值 RSS
+  output_bytes     生成的 docx 大小
+
+另以 --throughput-case 的範本經 /generate-from-template (下載範本 → 渲染 → 上傳,storage 為本地 stub)
+量測不同同時請求數下的吞吐量 (docs/sec);每個請求的章節內容不同,章節快取不會命中。
+
+用法:
+  python bench_generate.py                      # 與 baseline 比較,超過門檻即 exit 1
+  python bench_generate.py --update-baseline    # 重新產生 baseline
+  python bench_generate.py --cases small,medium --concurrency 1,4 --threshold 0.3
+"""
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import resource
+import threading
+import subprocess
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import docx
+from docx.shared import Inches
+
+sys.path.append("/app")
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+DEFAULT_THRESHOLD = float(os.environ.get("BENCH_THRESHOLD", "0.25"))
+
+# sections: 章節數, paragraphs: 每章段落數 (章節長度), table_rows: 每章表格列數, images: 每章圖片數
+CASES = {
+    "small":  {"sections": 10,  "paragraphs": 3,  "table_rows": 0,  "images": 0},
+    "medium": {"sections": 50,  "paragraphs": 8,  "table_rows": 5,  "images": 1},
+    "large":  {"sections": 200, "paragraphs": 12, "table_rows": 10, "images": 1},
+    "xlarge": {"sections": 500, "paragraphs": 15, "table_rows": 10, "images": 2},
+}
+
+# 各指標的絕對差值下限: small 案例的 render / save 只有數十毫秒,排程抖動就會超過百分比門檻;
+# soffice 每次轉檔的啟動時間本身就差 ±0.5 秒;上傳到本地 stub 只有幾毫秒
+MIN_DELTA = {
+    "render_seconds": 0.05,
+    "save_seconds": 0.05,
+    "service_seconds": 0.05,
+    "cached_seconds": 0.05,
+    "pdf_seconds": 0.5,
+    "upload_seconds": 0.02,
+    "peak_rss_mb": 5.0,
+    "output_bytes": 1024,
+}
+# 吞吐量越低越差
+MIN_THROUGHPUT_DELTA = 0.5
+
+PARAGRAPH_TEXT = "本公司依需求說明書規劃系統架構、資料介接與資安防護,並提供完整的教育訓練與維運服務。" * 2
+
+# ---------- 合成範本與資料 ----------
+
+def make_png(width, height, seed):
+    """
+    章節內的示意圖 (讓 PDF 轉檔包含圖片版面)。與 template-parsing-service/bench_parse.py 的同名函式相同:
+    兩個服務分開部署,基準腳本不跨服務匯入
+    """
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    color = bytes(((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256))
+    raw = b"".join(b"\x00" + color * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw))
+            + chunk(b"IEND", b""))
+
+def build_template(spec):
+    """章節迴圈範本: 與 /generate-from-template 相同的 project_title / sections 結構"""
+    doc = docx.Document()
+    doc.add_heading("{{ project_title }}", level=0)
+    doc.add_paragraph("{%p for s in sections %}")
+    doc.add_heading("{{ s.title }}", level=1)
+    doc.add_paragraph("{{ s.content }}")
+    doc.add_paragraph("{%p for text in s.paragraphs %}")
+    doc.add_paragraph("{{ text }}")
+    doc.add_paragraph("{%p endfor %}")
+
+    if spec["table_rows"]:
+        table = doc.add_table(rows=4, cols=3)
+        table.style = "Table Grid"
+        for cell, text in zip(table.rows[0].cells, ["項目", "數量", "金額"]):
+            cell.text = text
+        table.cell(1, 0).text = "{%tr for row in s.rows %}"
+        for cell, text in zip(table.rows[2].cells, ["{{ row.item }}", "{{ row.qty }}", "{{ row.amount }}"]):
+            cell.text = text
+        table.cell(3, 0).text = "{%tr endfor %}"
+
+    for i in range(spec["images"]):
+        doc.add_paragraph().add_run().add_picture(io.BytesIO(make_png(64, 32, i + 1)), width=Inches(1))
+
+    doc.add_paragraph("{%p endfor %}")
+    doc.add_paragraph("以上,敬請 鑒核。")
+    return doc
+
+def build_sections(spec, seed=0):
+    return [
+        {
+            "title": f"第 {i + 1} 章 服務建議 {seed}",
+            "content": PARAGRAPH_TEXT,
+            "paragraphs": [f"{i + 1}.{j + 1} {PARAGRAPH_TEXT}" for j in range(spec["paragraphs"])],
+            "rows": [{"item": f"項目 {r + 1}", "qty": r + 1, "amount": f"{(r + 1) * 1000:,}"}
+                     for r in range(spec["table_rows"])],
+        }
+        for i in range(spec["sections"])
+    ]
+
+def build_context(spec, seed=0):
+    return {"project_title": "效能基準測試建議書", "sections": build_sections(spec, seed)}
+
+# ---------- 本地 storage stub ----------
+
+class _StorageHandler(BaseHTTPRequestHandler):
+    """模擬 Supabase Storage: GET 回傳範本 (支援 ETag 304),POST 讀完上傳內容即回 200"""
+    protocol_version = "HTTP/1.1"
+    # 標頭與內容一次送出,避免 delayed ACK 讓每次上傳多出約 40ms
+    wbufsize = 64 * 1024
+    template = b""
+
+    def _reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == '"bench"':
+            self._reply(304, headers={"ETag": '"bench"'})
+        else:
+            self._reply(200, self.template, {"ETag": '"bench"'})
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    break
+        else:
+            self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        self._reply(200, b"{}", {"Content-Type": "application/json"})
+
+    def log_message(self, format, *args):
+        pass
+
+def start_storage_stub(template_bytes):
+    _StorageHandler.template = template_bytes
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StorageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["SUPABASE_URL"] = f"http://127.0.0.1:{server.server_port}"
+    os.environ["SUPABASE_SERVICE_KEY"] = "bench"
+    return server
+
+# ---------- 單一案例 (子行程) ----------
+
+def best_of(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 4), result
+
+def import_service():
+    import service
+    logging.getLogger("service").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    return service
+
+def run_case(name, docx_path, repeat, skip_pdf):
+    from docxtpl import DocxTemplate
+
+    with open(docx_path, "rb") as f:
+        template_bytes = f.read()
+    server = start_storage_stub(template_bytes)
+    service = import_service()
+    spec = CASES[name]
+    context = build_context(spec)
+    stream = spec["sections"] >= service.STREAM_ASSEMBLY_MIN_SECTIONS
+
+    def docxtpl_render():
+        doc = DocxTemplate(io.BytesIO(template_bytes))
+        doc.render(context)
+        return doc
+    render_seconds, doc = best_of(docxtpl_render, repeat)
+
+    def docxtpl_save():
+        output = io.BytesIO()
+        doc.save(output)
+        return output
+    save_seconds, _ = best_of(docxtpl_save, repeat)
+
+    def service_render(compiled=None):
+        output = io.BytesIO()
+        service.render_template_to(compiled or service.CompiledTemplate(template_bytes, ("bench",)),
+                                   context, output, stream)
+        return output
+    service_seconds, output = best_of(service_render, repeat)
+    compiled = service.CompiledTemplate(template_bytes, ("bench",))
+    service_render(compiled)
+    cached_seconds, _ = best_of(lambda: service_render(compiled), repeat)
+
+    with tempfile.TemporaryDirectory(prefix="bench_out_") as tmp:
+        generated = os.path.join(tmp, "bench_generated.docx")
+        with open(generated, "wb") as f:
+            f.write(output.getvalue())
+
+        pdf_seconds = None
+        if not skip_pdf and shutil.which("soffice"):
+            worker = service.LibreOfficeWorker(0, Path(tmp) / "profiles")
+            worker.warm()
+            pdf_path = Path(tmp) / "bench_generated.pdf"
+            pdf_seconds, _ = best_of(lambda: worker.convert(Path(generated), pdf_path, service.PDF_TIMEOUT),
+                                     repeat)
+
+        async def upload_best():
+            # 第一次上傳建立連線,不計入
+            with open(generated, "rb") as f:
+                await service.upload_generated_file("bench/bench_generated.docx", f, service.DOCX_MEDIA_TYPE)
+            best = None
+            for _ in range(repeat):
+                with open(generated, "rb") as f:
+                    start = time.perf_counter()
+                    await service.upload_generated_file("bench/bench_generated.docx", f, service.DOCX_MEDIA_TYPE)
+                    elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            await service.get_http_client().aclose()
+            return round(best, 4)
+        upload_seconds = asyncio.run(upload_best())
+
+    server.shutdown()
+    # Linux 的 ru_maxrss 單位為 KB
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        "render_seconds": render_seconds,
+        "save_seconds": save_seconds,
+        "service_seconds": service_seconds,
+        "cached_seconds": cached_seconds,
+        "pdf_seconds": pdf_seconds,
+        "upload_seconds": upload_seconds,
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "output_bytes": len(output.getvalue()),
+        "stream_assembly": stream,
+    }
+
+def run_throughput(name, docx_path, levels, requests_per_worker):
+    import httpx
+
+    with open(docx_path, "rb") as f:
+        server = start_storage_stub(f.read())
+    service = import_service()
+    spec = CASES[name]
+
+    def request_body(seed):
+        return {
+            "project_id": f"{seed:08d}",
+            "project_title": f"bench_{name}",
+            "template_id": "bench",
+            "template_file_path": f"templates/bench_{name}.docx",
+            "sections": [{"id": str(i), "title": s["title"], "content": s["content"]}
+                         for i, s in enumerate(build_sections(spec, seed))],
+            "user_id": "bench",
+        }
+
+    async def main():
+        results = {}
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=600) as client:
+            # 第一個請求下載並編譯範本,不計入
+            response = await client.post("/generate-from-template", json=request_body(0))
+            response.raise_for_status()
+            seed = 1
+            for level in levels:
+                total = level * requests_per_worker
+                bodies = [request_body(seed + i) for i in range(total)]
+                seed += total
+                semaphore = asyncio.Semaphore(level)
+
+                async def send(body):
+                    async with semaphore:
+                        r = await client.post("/generate-from-template", json=body)
+                        r.raise_for_status()
+
+                start = time.perf_counter()
+                await asyncio.gather(*[send(body) for body in bodies])
+                results[str(level)] = round(total / (time.perf_counter() - start), 2)
+        await service.get_http_client().aclose()
+        return results
+
+    docs_per_sec = asyncio.run(main())
+    server.shutdown()
+    return {
+        "docs_per_sec": docs_per_sec,
+        "render_workers": service.RENDER_WORKERS,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def measure(args):
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *args],
+        capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"benchmark case failed: {' '.join(args)}\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+# ---------- 比較 ----------
+
+def compare(name, metrics, baseline, threshold):
+    regressions = []
+    for key, min_delta in MIN_DELTA.items():
+        old = baseline.get(key)
+        new = metrics.get(key)
+        if not old or new is None:
+            continue
+        if new > old * (1 + threshold) and new - old > min_delta:
+            regressions.append(f"{name}.{key}: {old} -> {new} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+def compare_throughput(metrics, baseline, threshold):
+    regressions = []
+    if baseline.get("case") != metrics["case"]:
+        return regressions
+    for level, new in metrics["docs_per_sec"].items():
+        old = baseline.get("docs_per_sec", {}).get(level)
+        if not old:
+            continue
+        if new < old * (1 - threshold) and old - new > MIN_THROUGHPUT_DELTA:
+            regressions.append(f"throughput.c{level}: {old} -> {new} docs/s ({(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="document-generation-service benchmark")
+    parser.add_argument("--cases", default=",".join(CASES), help="逗號分隔的案例名稱")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="允許的相對退化比例")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--corpus-dir", help="保留合成範本的目錄 (預設使用暫存目錄)")
+    parser.add_argument("--skip-pdf", action="store_true", help="不量測 PDF 轉檔")
+    parser.add_argument("--concurrency", default="1,4,8", help="吞吐量量測的同時請求數,空字串表示不量測")
+    parser.add_argument("--throughput-case", default="medium")
+    parser.add_argument("--requests-per-worker", type=int, default=4)
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--run-throughput", help=argparse.SUPPRESS)
+    parser.add_argument("--docx", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    levels = [int(n) for n in args.concurrency.split(",") if n.strip()]
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.docx, args.repeat, args.skip_pdf)))
+        return 0
+    if args.run_throughput:
+        print(json.dumps(run_throughput(args.run_throughput, args.docx, levels, args.requests_per_worker)))
+        return 0
+
+    names = [n.strip() for n in args.cases.split(",") if n.strip()]
+    unknown = [n for n in names + [args.throughput_case] if n not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    results = {}
+    throughput = None
+    regressions = []
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_dir = args.corpus_dir or tmp
+        os.makedirs(corpus_dir, exist_ok=True)
+
+        def template_path(name):
+            path = os.path.join(corpus_dir, f"bench_{name}.docx")
+            if not os.path.exists(path):
+                build_template(CASES[name]).save(path)
+            return path
+
+        print(f"{'case':<8}{'render':>9}{'save':>9}{'service':>9}{'cached':>9}{'pdf':>9}{'upload':>9}"
+              f"{'RSS (MB)':>10}{'docx (KB)':>11}")
+        for name in names:
+            case_args = ["--run-case", name, "--docx", template_path(name), "--repeat", str(args.repeat)]
+            metrics = measure(case_args + (["--skip-pdf"] if args.skip_pdf else []))
+            results[name] = metrics
+            pdf = "-" if metrics["pdf_seconds"] is None else f"{metrics['pdf_seconds']:.3f}"
+            print(f"{name:<8}{metrics['render_seconds']:>9.3f}{metrics['save_seconds']:>9.3f}"
+                  f"{metrics['service_seconds']:>9.3f}{metrics['cached_seconds']:>9.3f}{pdf:>9}"
+                  f"{metrics['upload_seconds']:>9.3f}{metrics['peak_rss_mb']:>10.1f}{metrics['output_bytes'] / 1024:>11.0f}")
+            if name in baseline.get("cases", {}):
+                regressions.extend(compare(name, metrics, baseline["cases"][name], args.threshold))
+
+        if levels:
+            throughput = measure(["--run-throughput", args.throughput_case, "--docx", template_path(args.throughput_case),
+                                  "--concurrency", args.concurrency,
+                                  "--requests-per-worker", str(args.requests_per_worker)])
+            throughput["case"] = args.throughput_case
+            print(f"\nThroughput ({args.throughput_case}, RENDER_WORKERS={throughput['render_workers']}):")
+            for level, docs_per_sec in throughput["docs_per_sec"].items():
+                print(f"  concurrency {level:>3}: {docs_per_sec:>8.2f} docs/s")
+            if baseline.get("throughput"):
+                regressions.extend(compare_throughput(throughput, baseline["throughput"], args.threshold))
+
+    if args.update_baseline or not baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "cases": results, "throughput": throughput}, f, indent=2)
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"\nFAILURE: regressions beyond {args.threshold * 100:.0f}%:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"\nSUCCESS: no regressions beyond {args.threshold * 100:.0f}%.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,16 +3,35 @@ Document Generation Service
 使用 docxtpl (基於 python-docx + Jinja2) 生成高保真 Word 文件
 """
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Body
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from docxtpl import DocxTemplate
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Union, IO, Callable
+from jinja2 import Environment, Template, meta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from docx import Document
+from docx.oxml.parser import element_class_lookup
+from lxml import etree
+import io
 import os
+import re
+import hashlib
+import time
+import queue
+import shutil
+import signal
+import asyncio
 import subprocess
 import json
 import tempfile
+import threading
+import zipfile
+import uuid
 from pathlib import Path
+from urllib.parse import quote
 import logging
 import httpx
 
@@ -39,15 +58,874 @@ OUTPUT_DIR = BASE_DIR / "output"
 TEMPLATES_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# ==================== 範本快取 ====================
+# docxtpl 每次 render 都會重新讀檔、patch_xml (大量 regex) 並編譯 Jinja 範本,
+# 同一份範本重複生成時這些步驟的結果都一樣,快取後每次只需載入 Document + 渲染
+
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "32"))
+SECTION_CACHE_MB = int(os.getenv("SECTION_CACHE_MB", "32"))
+
+class SectionFragmentCache:
+    """
+    已渲染的章節片段 (見 SectionLoop),所有範本共用一個 max_bytes 的 LRU;
+    範本快取只計範本檔大小,片段不論屬於哪個範本都不會超過這個上限
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._fragments: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.evictions = 0
+
+    def get(self, scope: str, key: str) -> Optional[str]:
+        with self._lock:
+            fragment = self._fragments.get((scope, key))
+            if fragment is not None:
+                self._fragments.move_to_end((scope, key))
+            return fragment
+
+    def put(self, scope: str, key: str, fragment: str):
+        # 以字元數估算大小
+        with self._lock:
+            previous = self._fragments.pop((scope, key), None)
+            if previous is not None:
+                self.size_bytes -= len(previous)
+            self._fragments[(scope, key)] = fragment
+            self.size_bytes += len(fragment)
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._fragments.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "fragments": len(self._fragments),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+section_fragment_cache = SectionFragmentCache(SECTION_CACHE_MB * 1024 * 1024)
+
+class CompiledTemplate:
+    """快取項目: 範本檔內容 + 各 XML part (以 partname 為 key) 已 patch 並編譯好的 Jinja 範本"""
+
+    def __init__(self, data: bytes, version: tuple):
+        self.data = data
+        self.version = version
+        self.parts: Dict[str, Template] = {}
+        # 章節迴圈拆分結果 (見 SectionLoop);渲染好的片段放在 section_fragment_cache,以 fragment_scope 區分範本
+        self.section_loops: Dict[str, Optional["SectionLoop"]] = {}
+        self.fragment_scope = uuid.uuid4().hex
+
+    def get_fragment(self, key: str) -> Optional[str]:
+        return section_fragment_cache.get(self.fragment_scope, key)
+
+    def put_fragment(self, key: str, fragment: str):
+        section_fragment_cache.put(self.fragment_scope, key, fragment)
+
+class _CompiledPartEnv:
+    """傳給 render_xml_part 的 jinja_env: 直接回傳已編譯的範本"""
+
+    def __init__(self, template: Template):
+        self.template = template
+
+    def from_string(self, source):
+        return self.template
+
+class _CompilingPartEnv:
+    """第一次渲染時使用: 與 docxtpl 未指定 jinja_env 時相同以 Template() 編譯,並存入快取"""
+
+    def __init__(self, compiled: "CompiledTemplate", partname: str):
+        self.compiled = compiled
+        self.partname = partname
+
+    def from_string(self, source):
+        template = Template(source)
+        self.compiled.section_loops[self.partname] = split_section_loop(source)
+        self.compiled.parts[self.partname] = template
+        return template
+
+class _StaticTemplate:
+    """render() 直接回傳已渲染好的 XML,用來套用 render_xml_part 的後處理 (resolve_listing 等)"""
+
+    def __init__(self, xml: str):
+        self.xml = xml
+
+    def render(self, context):
+        return self.xml
+
+# ---------- 章節片段快取 ----------
+# 撰寫建議書時每次通常只修改一個章節: 將本文中最外層的 {% for x in sections %} 拆出,
+# 每個章節單獨渲染 (含 resolve_listing 後處理) 並以內容 hash 快取,未變動的章節直接沿用。
+# 迴圈必須以整個段落為界 (例如 {%p for %}),前面不能有 set/macro 等會影響迴圈內容的語法,
+# 不符合時整份文件照常渲染
+
+# 重新解析整份 document.xml 用 (與 python-docx 相同的 element class,保留空白文字節點)
+DOCUMENT_XML_PARSER = etree.XMLParser(resolve_entities=False, huge_tree=True)
+DOCUMENT_XML_PARSER.set_element_class_lookup(element_class_lookup)
+
+SECTION_LOOP_VAR = "sections"
+SECTION_LOOP_MARKER = "__section_loop_fragments__"
+SECTION_LOOP_PLACEHOLDER = f"<w:p><w:r><w:t>{SECTION_LOOP_MARKER}</w:t></w:r></w:p>"
+DOCPR_ID_PATTERN = re.compile(r'(<wp:docPr\b[^>]*?\bid=")\d+(")')
+XMLNS_PATTERN = re.compile(r'xmlns(?::\w+)?="[^"]*"')
+SUPPORTED_LOOP_ATTRS = {"index", "index0", "revindex", "revindex0", "first", "last", "length", "cycle"}
+BLOCK_OPENERS = {"for", "if", "macro", "call", "filter", "block", "with", "autoescape"}
+BLOCK_TAG_PATTERN = re.compile(r"\{%(-?)\s*(\w+)(.*?)(-?)%\}", re.DOTALL)
+SECTION_LOOP_HEADER = re.compile(r"\s+(\w+)\s+in\s+" + SECTION_LOOP_VAR + r"\s*$")
+SCOPE_TAG_PATTERN = re.compile(r"\{%-?\s*(set|macro|import|from|include|with)\b")
+
+class SectionLoop:
+    """本文拆成: 外層範本 (迴圈位置換成 marker) + 單一章節的迴圈內容範本"""
+
+    def __init__(self, outer: Template, item: Template, loop_var: str, outer_vars: List[str], uses_loop: bool):
+        self.outer = outer
+        self.item = item
+        self.loop_var = loop_var
+        self.outer_vars = outer_vars
+        self.uses_loop = uses_loop
+
+class _LoopState:
+    """單獨渲染迴圈內容時代替 Jinja 的 loop 變數"""
+
+    def __init__(self, index0: int, length: int):
+        self.index0 = index0
+        self.index = index0 + 1
+        self.revindex0 = length - index0 - 1
+        self.revindex = length - index0
+        self.first = index0 == 0
+        self.last = index0 == length - 1
+        self.length = length
+
+    def cycle(self, *values):
+        return values[self.index0 % len(values)]
+
+def _paragraphs_balanced(xml: str) -> bool:
+    return len(re.findall(r"<w:p[ >]", xml)) == xml.count("</w:p>")
+
+def split_section_loop(source: str) -> Optional[SectionLoop]:
+    """找出唯一一個最外層的 sections 迴圈並拆分,不適用時回傳 None"""
+    depth = 0
+    header = None
+    footer = None
+    for m in BLOCK_TAG_PATTERN.finditer(source):
+        strip_left, name, rest, strip_right = m.groups()
+        if name == "raw":
+            return None
+        if name in BLOCK_OPENERS or (name == "set" and "=" not in rest):
+            if depth == 0 and name == "for" and SECTION_LOOP_HEADER.match(rest):
+                if header is not None or strip_left or strip_right:
+                    return None
+                header = m
+            depth += 1
+        elif name.startswith("end"):
+            depth -= 1
+            if depth == 0 and header is not None and footer is None:
+                if name != "endfor" or strip_left or strip_right:
+                    return None
+                footer = m
+        elif name == "else" and depth == 1 and header is not None and footer is None:
+            return None  # for ... else
+    if header is None or footer is None:
+        return None
+
+    prefix = source[:header.start()]
+    body = source[header.end():footer.start()]
+    suffix = source[footer.end():]
+    if SCOPE_TAG_PATTERN.search(prefix) or not _paragraphs_balanced(prefix) or not _paragraphs_balanced(body):
+        return None
+    if any(attr not in SUPPORTED_LOOP_ATTRS for attr in re.findall(r"\bloop\.(\w+)", body)):
+        return None
+
+    loop_var = SECTION_LOOP_HEADER.match(header.group(3)).group(1)
+    body_vars = meta.find_undeclared_variables(Environment().parse(body))
+    return SectionLoop(
+        Template(prefix + "{{ " + SECTION_LOOP_MARKER + " }}" + suffix),
+        Template(body),
+        loop_var,
+        sorted(body_vars - {loop_var, "loop"}),
+        "loop" in body_vars
+    )
+
+def _section_key(section_loop: SectionLoop, context: Dict[str, Any], item: Any,
+                 index0: int, length: int) -> Optional[str]:
+    """章節片段的 cache key: 章節內容 + 迴圈內引用的外層變數 (+ 用到 loop 時的位置);無法序列化時不快取"""
+    position = [index0, length] if section_loop.uses_loop else None
+    try:
+        payload = json.dumps(
+            [item, [context.get(name) for name in section_loop.outer_vars], position],
+            ensure_ascii=False, sort_keys=True
+        )
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class CachedDocxTemplate(DocxTemplate):
+    """
+    使用 CompiledTemplate 的 DocxTemplate
+    每次請求仍從快取的 bytes 載入新的 Document (render 會修改 Document),
+    本文與頁首/頁尾則略過 patch_xml + 編譯;指定 jinja_env 時退回 docxtpl 原本流程
+    """
+
+    def __init__(self, compiled: CompiledTemplate, section_cache: bool = False, stream_sections: bool = False,
+                 progress: Optional[Callable[[int, int], None]] = None):
+        super().__init__(io.BytesIO(compiled.data))
+        self.compiled = compiled
+        self.section_cache = section_cache or stream_sections
+        self.stream_sections = stream_sections
+        self.progress = progress  # 每完成一個章節呼叫 progress(完成數, 總數)
+        self._pending_sections = None
+        self.section_hits = 0
+        self.section_misses = 0
+
+    def _render_part(self, part, get_xml, context, jinja_env):
+        if jinja_env is not None:
+            return self.render_xml_part(self.patch_xml(get_xml()), part, context, jinja_env)
+
+        partname = str(part.partname)
+        template = self.compiled.parts.get(partname)
+        if template is None:
+            env = _CompilingPartEnv(self.compiled, partname)
+            return self.render_xml_part(self.patch_xml(get_xml()), part, context, env)
+        return self.render_xml_part("", part, context, _CompiledPartEnv(template))
+
+    def _postprocess(self, part, xml: str) -> str:
+        return self.render_xml_part("", part, {}, _CompiledPartEnv(_StaticTemplate(xml)))
+
+    def _iter_section_fragments(self, part, section_loop: SectionLoop, context):
+        """依序產生 sections 迴圈每個章節的 XML 片段,優先使用快取"""
+        items = list(context.get(SECTION_LOOP_VAR) or [])
+        for index0, item in enumerate(items):
+            key = _section_key(section_loop, context, item, index0, len(items))
+            fragment = self.compiled.get_fragment(key) if key else None
+            if fragment is None:
+                self.section_misses += 1
+                item_context = dict(context)
+                item_context[section_loop.loop_var] = item
+                item_context["loop"] = _LoopState(index0, len(items))
+                self.current_rendering_part = part
+                fragment = self._postprocess(part, section_loop.item.render(item_context))
+                if key:
+                    self.compiled.put_fragment(key, fragment)
+            else:
+                self.section_hits += 1
+            if self.progress is not None:
+                self.progress(index0 + 1, len(items))
+            yield fragment
+
+    def _render_outer(self, part, section_loop: SectionLoop, context):
+        """渲染迴圈以外的本文,回傳迴圈位置前後兩段"""
+        outer_context = dict(context)
+        outer_context[SECTION_LOOP_MARKER] = SECTION_LOOP_MARKER
+        self.current_rendering_part = part
+        head, tail = section_loop.outer.render(outer_context).split(SECTION_LOOP_MARKER, 1)
+        return self._postprocess(part, head), self._postprocess(part, tail)
+
+    def build_xml(self, context, jinja_env=None):
+        part = self.docx._part
+        if self.section_cache and jinja_env is None:
+            section_loop = self.compiled.section_loops.get(str(part.partname))
+            if section_loop is not None:
+                if self.stream_sections:
+                    # 章節留到 save_assembled 時才逐一渲染寫出,本文只放一個佔位段落
+                    head, tail = self._render_outer(part, section_loop, context)
+                    self._pending_sections = (part, section_loop, context)
+                    return head + SECTION_LOOP_PLACEHOLDER + tail
+                fragments = "".join(self._iter_section_fragments(part, section_loop, context))
+                head, tail = self._render_outer(part, section_loop, context)
+                return head + fragments + tail
+        return self._render_part(part, self.get_xml, context, jinja_env)
+
+    def map_tree(self, tree):
+        """
+        docxtpl 以 root.replace(body, tree) 將渲染結果移入原文件,lxml 需逐一調整每個節點的 namespace,
+        數十萬節點的大型文件要花上數秒;改為把整份 document.xml 重新解析後替換 document part 的根節點
+        """
+        root = self.docx._element
+        placeholder = etree.Element(root.body.tag)
+        root.replace(root.body, placeholder)
+        head, marker, tail = etree.tostring(root, encoding="unicode").partition("<w:body/>")
+        if not marker or "<w:body/>" in tail:
+            root.replace(placeholder, tree)
+            return
+        body_xml = etree.tostring(tree, encoding="unicode")
+        # 與 lxml 移動節點時相同: 去掉 body 上與根節點重複的 namespace 宣告
+        if not tree.attrib and all(root.nsmap.get(prefix) == uri for prefix, uri in tree.nsmap.items()):
+            start_tag_end = body_xml.index(">") + 1
+            body_xml = ("<w:body/>" if body_xml[start_tag_end - 2] == "/" else "<w:body>") + body_xml[start_tag_end:]
+        new_root = etree.fromstring(head + body_xml + tail, DOCUMENT_XML_PARSER)
+        self.docx._part._element = new_root
+        self.docx._element = new_root
+        self.docx._Document__body = None
+
+    def build_headers_footers_xml(self, context, uri, jinja_env=None):
+        for relKey, part in self.get_headers_footers(uri):
+            xml = self.get_part_xml(part)
+            encoding = self.get_headers_footers_encoding(xml)
+            xml = self._render_part(part, lambda: xml, context, jinja_env)
+            yield relKey, xml.encode(encoding)
+
+    def _finalize_fragment(self, fragment: str, xmlns: str) -> str:
+        """串流組裝時對單一章節做 docxtpl 原本對整份本文做的處理: 表格欄位修正、圖片 docPr id 重新編號"""
+        if "<w:tbl" in fragment:
+            tree = self.fix_tables(f"<w:body {xmlns}>{fragment}</w:body>")
+            body_xml = etree.tostring(tree, encoding="unicode")
+            fragment = body_xml[body_xml.index(">") + 1:body_xml.rindex("</w:body>")]
+        if "docPr" in fragment:
+            def renumber(m):
+                self.docx_ids_index += 1
+                return f"{m.group(1)}{self.docx_ids_index}{m.group(2)}"
+            fragment = DOCPR_ID_PATTERN.sub(renumber, fragment)
+        return fragment
+
+    def save_assembled(self, target):
+        """
+        串流組裝 (需以 stream_sections=True 渲染): 其餘 part 照常儲存,
+        document.xml 則在佔位段落處逐一寫入章節片段,記憶體中同時只有一個章節
+        """
+        part, section_loop, context = self._pending_sections
+        package = io.BytesIO()
+        self.save(package)
+        document_name = str(part.partname).lstrip("/")
+
+        with zipfile.ZipFile(package) as zin, zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                if info.filename != document_name:
+                    zout.writestr(info, zin.read(info))
+                    continue
+                head, placeholder, tail = zin.read(info).decode("utf-8").partition(SECTION_LOOP_PLACEHOLDER)
+                if not placeholder:
+                    raise Exception("串流組裝失敗: 找不到章節佔位段落")
+                root_start = head[head.index("<w:document"):]
+                xmlns = " ".join(XMLNS_PATTERN.findall(root_start[:root_start.index(">")]))
+                member = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                member.compress_type = zipfile.ZIP_DEFLATED
+                with zout.open(member, "w", force_zip64=True) as out:
+                    out.write(head.encode("utf-8"))
+                    for fragment in self._iter_section_fragments(part, section_loop, context):
+                        out.write(self._finalize_fragment(fragment, xmlns).encode("utf-8"))
+                    out.write(tail.encode("utf-8"))
+
+class TemplateCache:
+    """範本 LRU 快取: 以路徑為 key,mtime/size 變動即視為新版本重新載入"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, CompiledTemplate]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path: Path) -> CompiledTemplate:
+        stat = path.stat()
+        key = str(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = CompiledTemplate(path.read_bytes(), version)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, path: Path):
+        with self._lock:
+            self._entries.pop(str(path), None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+template_cache = TemplateCache(TEMPLATE_CACHE_SIZE)
+
+# Supabase 上的範本: 同一專案反覆調整章節時會一直重新生成,範本本身很少變動
+REMOTE_TEMPLATE_CACHE_MB = int(os.getenv("REMOTE_TEMPLATE_CACHE_MB", "64"))
+REMOTE_TEMPLATE_MAX_AGE = int(os.getenv("REMOTE_TEMPLATE_MAX_AGE", "0"))
+
+class RemoteTemplate:
+    def __init__(self, compiled: CompiledTemplate, etag: Optional[str], last_modified: Optional[str]):
+        self.compiled = compiled
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated_at = time.monotonic()
+
+class RemoteTemplateCache:
+    """
+    遠端範本快取: 以 storage 路徑為 key,超過 max_age 後以 ETag / Last-Modified 條件式請求重新驗證
+    (304 即沿用快取,不重新下載);依範本檔總大小 LRU 淘汰。只在 event loop 中使用,不需要鎖
+    """
+
+    def __init__(self, max_bytes: int, max_age: int):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries: "OrderedDict[str, RemoteTemplate]" = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+        self.evictions = 0
+
+    async def get(self, client: httpx.AsyncClient, storage_path: str, url: str) -> CompiledTemplate:
+        entry = self._entries.get(storage_path)
+        if entry is not None and time.monotonic() - entry.validated_at < self.max_age:
+            self._entries.move_to_end(storage_path)
+            self.hits += 1
+            return entry.compiled
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        try:
+            response = await client.get(url, headers=headers)
+        except httpx.HTTPError as e:
+            if entry is None:
+                raise
+            # 無法連線時沿用快取中的版本
+            logger.warning(f"範本重新驗證失敗,使用快取: {storage_path} ({str(e)})")
+            return entry.compiled
+
+        if response.status_code == 304 and entry is not None:
+            entry.validated_at = time.monotonic()
+            self._entries.move_to_end(storage_path)
+            self.revalidated += 1
+            return entry.compiled
+        if response.status_code != 200:
+            self._remove(storage_path)
+            raise HTTPException(
+                status_code=404,
+                detail=f"無法下載範本: {response.status_code}"
+            )
+
+        self.downloads += 1
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        compiled = CompiledTemplate(response.content, (etag, last_modified))
+        self._remove(storage_path)
+        if len(compiled.data) <= self.max_bytes:
+            self._entries[storage_path] = RemoteTemplate(compiled, etag, last_modified)
+            self.size_bytes += len(compiled.data)
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted.compiled.data)
+                self.evictions += 1
+        return compiled
+
+    def _remove(self, storage_path: str):
+        entry = self._entries.pop(storage_path, None)
+        if entry is not None:
+            self.size_bytes -= len(entry.compiled.data)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "downloads": self.downloads,
+            "evictions": self.evictions,
+        }
+
+remote_template_cache = RemoteTemplateCache(REMOTE_TEMPLATE_CACHE_MB * 1024 * 1024, REMOTE_TEMPLATE_MAX_AGE)
+
+# ==================== PDF 轉檔池 ====================
+# 每個 worker 使用獨立的 LibreOffice profile (-env:UserInstallation),
+# 同時轉檔不會互搶同一個 profile 的鎖;profile 於啟動時先做一次空白轉檔預熱,
+# 轉檔失敗或超時即砍掉整個行程群組並重建 profile
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "2"))
+PDF_MAX_QUEUE = int(os.getenv("PDF_MAX_QUEUE", "16"))
+PDF_TIMEOUT = int(os.getenv("PDF_TIMEOUT", "60"))
+LIBREOFFICE_PROFILE_DIR = Path(os.getenv("LIBREOFFICE_PROFILE_DIR", Path(tempfile.gettempdir()) / "lo_profiles"))
+LIBREOFFICE_HEALTH_TTL = int(os.getenv("LIBREOFFICE_HEALTH_TTL", "60"))
+
+class LibreOfficeWorker:
+    """單一 LibreOffice worker: 固定 profile 目錄,一次處理一個轉檔"""
+
+    def __init__(self, index: int, profile_root: Path):
+        self.index = index
+        self.profile_dir = profile_root / f"worker_{index}"
+        self.ready = False
+        self.jobs = 0
+        self.failures = 0
+        self.restarts = 0
+        self._process: Optional[subprocess.Popen] = None
+
+    def _command(self, *args) -> List[str]:
+        return [
+            "soffice",
+            f"-env:UserInstallation={self.profile_dir.resolve().as_uri()}",
+            "--headless", "--norestore", "--nologo", "--nodefault", "--nolockcheck",
+            *args
+        ]
+
+    def _run(self, args: List[str], timeout: int):
+        # start_new_session: 超時時連同 soffice.bin 子行程一起砍掉
+        self._process = subprocess.Popen(
+            self._command(*args),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True
+        )
+        try:
+            _, stderr = self._process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.kill()
+            raise
+        finally:
+            returncode = self._process.returncode
+            self._process = None
+        if returncode != 0:
+            raise Exception(f"LibreOffice 轉檔失敗: {stderr}")
+
+    def kill(self):
+        process = self._process
+        if process is None or process.poll() is not None:
+            return
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.communicate()
+
+    def warm(self):
+        """初始化 profile: 第一次啟動 LibreOffice 建立 profile 最耗時,轉一份空白文件讓它先完成"""
+        if self.ready:
+            return
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix="lo_warm_") as tmp:
+            blank = Path(tmp) / "warmup.docx"
+            Document().save(blank)
+            self._run(["--convert-to", "pdf", "--outdir", tmp, str(blank)], PDF_TIMEOUT)
+        self.ready = True
+        logger.info(f"LibreOffice worker {self.index} 預熱完成")
+
+    def restart(self):
+        self.kill()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+        self.ready = False
+        self.restarts += 1
+
+    def convert(self, docx_path: Path, pdf_path: Path, timeout: int):
+        self.warm()
+        self.jobs += 1
+        with tempfile.TemporaryDirectory(prefix="lo_out_") as outdir:
+            self._run(["--convert-to", "pdf", "--outdir", outdir, str(docx_path)], timeout)
+            produced = Path(outdir) / f"{docx_path.stem}.pdf"
+            if not produced.exists():
+                raise Exception("LibreOffice 轉檔失敗: 未產生 PDF")
+            shutil.move(str(produced), str(pdf_path))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "busy": self._process is not None,
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "restarts": self.restarts
+        }
+
+class PdfConverterPool:
+    """LibreOffice worker 池: 有上限的佇列,超過即回 503;每個 job 有獨立 timeout"""
+
+    def __init__(self, size: int, max_queue: int, profile_root: Path):
+        self.size = size
+        self.max_queue = max_queue
+        self.workers = [LibreOfficeWorker(i, profile_root) for i in range(size)]
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._idle: "queue.Queue[LibreOfficeWorker]" = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="soffice")
+
+    def start(self):
+        """背景預熱所有 worker (不阻塞服務啟動)"""
+        for _ in self.workers:
+            self._executor.submit(self._with_worker, self._warm)
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.kill()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _warm(self, worker: LibreOfficeWorker):
+        try:
+            worker.warm()
+        except Exception as e:
+            logger.warning(f"LibreOffice worker {worker.index} 預熱失敗: {str(e)}")
+            worker.restart()
+
+    def _with_worker(self, fn, *args):
+        worker = self._idle.get()
+        try:
+            return fn(worker, *args)
+        finally:
+            self._idle.put(worker)
+
+    def _convert(self, worker: LibreOfficeWorker, docx_path: Path, pdf_path: Path, timeout: int):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            worker.convert(docx_path, pdf_path, timeout)
+            with self._lock:
+                self.completed += 1
+        except subprocess.TimeoutExpired:
+            worker.failures += 1
+            worker.restart()
+            with self._lock:
+                self.timeouts += 1
+            raise Exception(f"PDF 轉檔超時 (>{timeout}秒)")
+        except Exception:
+            worker.failures += 1
+            worker.restart()
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    async def convert(self, docx_path: Path, pdf_path: Path, timeout: int = PDF_TIMEOUT):
+        with self._lock:
+            if self.running + self.queued >= self.size + self.max_queue:
+                self.rejected += 1
+                raise HTTPException(status_code=503, detail="PDF 轉檔佇列已滿,請稍後再試",
+                                    headers={"Retry-After": "10"})
+            self.queued += 1
+        future = self._executor.submit(self._with_worker, self._convert, docx_path, pdf_path, timeout)
+        future.add_done_callback(self._release_if_cancelled)
+        return await asyncio.wrap_future(future)
+
+    def _release_if_cancelled(self, future):
+        # 排隊中被取消 (等待的請求被取消、用戶端中斷或 shutdown) 時 _convert 不會執行,由此歸還名額
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            summary = {
+                "size": self.size,
+                "max_queue": self.max_queue,
+                "running": self.running,
+                "queued": self.queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected
+            }
+        summary["workers"] = [worker.stats() for worker in self.workers]
+        return summary
+
+pdf_pool = PdfConverterPool(PDF_WORKERS, PDF_MAX_QUEUE, LIBREOFFICE_PROFILE_DIR)
+
+@app.on_event("startup")
+async def start_pdf_pool():
+    pdf_pool.start()
+
+@app.on_event("shutdown")
+async def stop_pdf_pool():
+    pdf_pool.shutdown()
+
+# ==================== 輸出目錄 ====================
+# 每個請求使用獨立的工作目錄 (同範本同時生成不會互相覆寫),回應送出後於背景刪除;
+# 回應中斷或行程重啟留下的殘檔由定期清理依保留時間刪除
+
+OUTPUT_RETENTION_SECONDS = int(os.getenv("OUTPUT_RETENTION_SECONDS", "3600"))
+OUTPUT_SWEEP_INTERVAL = int(os.getenv("OUTPUT_SWEEP_INTERVAL", "600"))
+
+def create_work_dir(prefix: str) -> Path:
+    return Path(tempfile.mkdtemp(prefix=prefix, dir=OUTPUT_DIR))
+
+def remove_work_dir(path: Path):
+    shutil.rmtree(path, ignore_errors=True)
+
+def sweep_output_dir(max_age: int = OUTPUT_RETENTION_SECONDS) -> int:
+    """刪除 OUTPUT_DIR 中超過保留時間的檔案與工作目錄,回傳刪除數量"""
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in OUTPUT_DIR.iterdir():
+        try:
+            if entry.stat().st_mtime > cutoff:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry)
+            else:
+                entry.unlink()
+            removed += 1
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.warning(f"清理輸出檔失敗: {entry} ({str(e)})")
+    return removed
+
+async def _sweep_output_dir_periodically():
+    while True:
+        removed = await asyncio.to_thread(sweep_output_dir)
+        if removed:
+            logger.info(f"清理過期輸出: {removed} 項")
+        await asyncio.sleep(OUTPUT_SWEEP_INTERVAL)
+
+@app.on_event("startup")
+async def start_output_sweeper():
+    app.state.output_sweeper = asyncio.create_task(_sweep_output_dir_periodically())
+
+@app.on_event("shutdown")
+async def stop_output_sweeper():
+    app.state.output_sweeper.cancel()
+
+# ==================== 渲染與儲存 ====================
+# docxtpl 渲染是 CPU 密集的同步程式,交給 render_executor,event loop 只負責 I/O;
+# Supabase Storage 的下載/上傳共用同一個連線池
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "4"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+# 章節數達此門檻時改用串流組裝 (見 CachedDocxTemplate.save_assembled)
+STREAM_ASSEMBLY_MIN_SECTIONS = int(os.getenv("STREAM_ASSEMBLY_MIN_SECTIONS", "100"))
+# 輸出暫存檔超過此大小即寫入磁碟
+OUTPUT_SPOOL_BYTES = int(os.getenv("OUTPUT_SPOOL_MB", "16")) * 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+
+def render_template_file(template_path: Path, context: Dict[str, Any], docx_path: Path):
+    """以快取範本渲染並儲存 Docx (阻塞,於 render_executor 執行)"""
+    doc = CachedDocxTemplate(template_cache.get(template_path))
+    doc.render(context)
+    doc.save(docx_path)
+
+def render_template_to(compiled: CompiledTemplate, context: Dict[str, Any], output, stream_sections: bool = False,
+                       progress: Optional[Callable[[int, int], None]] = None):
+    """
+    渲染範本並寫入 output (未變動的章節沿用快取片段;阻塞,於 render_executor 執行)
+    stream_sections: 章節逐一寫入輸出 zip (串流組裝),範本不適用章節拆分時照常儲存
+    progress: 章節進度 callback (於 render 執行緒呼叫)
+    """
+    doc = CachedDocxTemplate(compiled, section_cache=True, stream_sections=stream_sections, progress=progress)
+    doc.render(context)
+    if doc._pending_sections is not None:
+        doc.save_assembled(output)
+    else:
+        doc.save(output)
+    if doc.section_hits or doc.section_misses:
+        logger.info(f"章節快取: 沿用 {doc.section_hits} / 重新渲染 {doc.section_misses}")
+
+async def run_in_render_executor(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(render_executor, fn, *args)
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """共用的 AsyncClient (keep-alive 連線池),第一次使用時建立"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+        )
+    return _http_client
+
+@app.on_event("shutdown")
+async def close_http_client():
+    if _http_client is not None:
+        await _http_client.aclose()
+
+def get_supabase_credentials():
+    supabase_url = os.getenv("SUPABASE_URL")
+    supabase_key = os.getenv("SUPABASE_SERVICE_KEY")
+    if not supabase_url or not supabase_key:
+        raise HTTPException(
+            status_code=500,
+            detail="Supabase 環境變數未設定"
+        )
+    return supabase_url, supabase_key
+
+async def upload_generated_file(storage_name: str, content: Union[bytes, IO[bytes]], media_type: str) -> str:
+    """上傳至 generated-documents bucket (content 可為 bytes 或檔案物件),回傳公開下載連結"""
+    supabase_url, supabase_key = get_supabase_credentials()
+    response = await get_http_client().post(
+        f"{supabase_url}/storage/v1/object/generated-documents/{storage_name}",
+        headers={
+            "Authorization": f"Bearer {supabase_key}",
+            "Content-Type": media_type
+        },
+        files={"file": (Path(storage_name).name, content, media_type)}
+    )
+    if response.status_code not in [200, 201]:
+        raise Exception(f"上傳失敗: {storage_name} ({response.status_code})")
+    return f"{supabase_url}/storage/v1/object/public/generated-documents/{storage_name}"
+
+def attachment_response(fileobj: IO[bytes], filename: str, media_type: str) -> StreamingResponse:
+    """分段回傳暫存檔內容 (檔名可含中文),送出後關閉"""
+    fileobj.seek(0)
+    return StreamingResponse(
+        iter(lambda: fileobj.read(STREAM_CHUNK_SIZE), b""),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}"},
+        background=BackgroundTask(fileobj.close)
+    )
+
+# ==================== API 端點 ====================
+
+_libreoffice_status = {"value": None, "checked_at": 0.0}
+
 @app.get("/health")
 async def health_check():
     """健康檢查"""
     return {
         "status": "healthy",
         "service": "document-generation",
-        "libreoffice": check_libreoffice()
+        "libreoffice": await get_libreoffice_status(),
+        "pdf_pool": pdf_pool.stats(),
+        "template_cache": template_cache.stats(),
+        "remote_template_cache": remote_template_cache.stats(),
+        "section_cache": section_fragment_cache.stats(),
+        "jobs": job_manager.stats()
     }
 
+async def get_libreoffice_status():
+    """LibreOffice 版本資訊,快取 LIBREOFFICE_HEALTH_TTL 秒,避免每次 /health 都啟動 soffice"""
+    if time.monotonic() - _libreoffice_status["checked_at"] > LIBREOFFICE_HEALTH_TTL:
+        _libreoffice_status["value"] = await asyncio.to_thread(check_libreoffice)
+        _libreoffice_status["checked_at"] = time.monotonic()
+    return _libreoffice_status["value"]
+
 def check_libreoffice():
     """檢查 LibreOffice 是否可用"""
     try:
@@ -79,53 +957,34 @@ async def generate_document(
         生成的文件
     """
     try:
-        # 1. 載入範本
-        template_path = TEMPLATES_DIR / template_name
-        if not template_path.exists():
-            raise HTTPException(
-                status_code=404,
-                detail=f"範本不存在: {template_name}"
-            )
+        # 1-2. 載入範本、解析 JSON 數據
+        template_path, context = load_generate_input(template_name, context_json)
         
-        logger.info(f"載入範本: {template_path}")
-        doc = DocxTemplate(template_path)
-        
-        # 2. 解析 JSON 數據
+        # 3. 渲染並儲存為 Docx (每個請求獨立的工作目錄)
+        work_dir = create_work_dir("generate_")
+        docx_path = work_dir / f"generated_{Path(template_name).name}"
         try:
-            context = json.loads(context_json)
-        except json.JSONDecodeError as e:
-            raise HTTPException(
-                status_code=400,
-                detail=f"JSON 格式錯誤: {str(e)}"
-            )
-        
-        logger.info(f"填入數據: {list(context.keys())}")
-        
-        # 3. 渲染文件
-        doc.render(context)
-        
-        # 4. 儲存為 Docx
-        output_filename = f"generated_{template_name}"
-        docx_path = OUTPUT_DIR / output_filename
-        doc.save(docx_path)
-        
-        logger.info(f"生成 Docx: {docx_path}")
-        
-        # 5. 如果需要 PDF,進行轉檔
-        if output_format.lower() == "pdf":
-            pdf_path = docx_path.with_suffix(".pdf")
-            convert_to_pdf(docx_path, pdf_path)
-            return FileResponse(
-                pdf_path,
-                media_type="application/pdf",
-                filename=pdf_path.name
-            )
+            await run_in_render_executor(render_template_file, template_path, context, docx_path)
+            
+            logger.info(f"生成 Docx: {docx_path}")
+            
+            # 4. 如果需要 PDF,進行轉檔
+            output_path = docx_path
+            media_type = DOCX_MEDIA_TYPE
+            if output_format.lower() == "pdf":
+                output_path = docx_path.with_suffix(".pdf")
+                media_type = "application/pdf"
+                await convert_to_pdf(docx_path, output_path)
+        except BaseException:
+            remove_work_dir(work_dir)
+            raise
         
-        # 6. 返回 Docx
+        # 5. 返回檔案,送出後刪除工作目錄
         return FileResponse(
-            docx_path,
-            media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            filename=docx_path.name
+            output_path,
+            media_type=media_type,
+            filename=output_path.name,
+            background=BackgroundTask(remove_work_dir, work_dir)
         )
         
     except HTTPException:
@@ -134,33 +993,37 @@ async def generate_document(
         logger.error(f"生成文件失敗: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-def convert_to_pdf(docx_path: Path, pdf_path: Path):
-    """使用 LibreOffice 將 Docx 轉為 PDF"""
+def load_generate_input(template_name: str, context_json: str):
+    """檢查範本是否存在並解析 context_json,回傳 (範本路徑, context)"""
+    template_path = TEMPLATES_DIR / template_name
+    if not template_path.exists():
+        raise HTTPException(
+            status_code=404,
+            detail=f"範本不存在: {template_name}"
+        )
+    
     try:
-        logger.info(f"轉檔為 PDF: {docx_path} -> {pdf_path}")
-        
-        result = subprocess.run(
-            [
-                "soffice",
-                "--headless",
-                "--convert-to", "pdf",
-                "--outdir", str(pdf_path.parent),
-                str(docx_path)
-            ],
-            capture_output=True,
-            text=True,
-            timeout=60
+        context = json.loads(context_json)
+    except json.JSONDecodeError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"JSON 格式錯誤: {str(e)}"
         )
-        
-        if result.returncode != 0:
-            raise Exception(f"LibreOffice 轉檔失敗: {result.stderr}")
-        
-        logger.info("PDF 轉檔成功")
-        
-    except subprocess.TimeoutExpired:
-        raise Exception("PDF 轉檔超時 (>60秒)")
+    
+    logger.info(f"載入範本: {template_path}")
+    logger.info(f"填入數據: {list(context.keys())}")
+    return template_path, context
+
+async def convert_to_pdf(docx_path: Path, pdf_path: Path):
+    """使用 LibreOffice worker 池將 Docx 轉為 PDF"""
+    logger.info(f"轉檔為 PDF: {docx_path} -> {pdf_path}")
+    try:
+        await pdf_pool.convert(docx_path, pdf_path)
+    except HTTPException:
+        raise
     except Exception as e:
         raise Exception(f"PDF 轉檔錯誤: {str(e)}")
+    logger.info("PDF 轉檔成功")
 
 @app.post("/upload-template")
 async def upload_template(file: UploadFile = File(...)):
@@ -177,6 +1040,8 @@ async def upload_template(file: UploadFile = File(...)):
         with open(template_path, "wb") as f:
             content = await file.read()
             f.write(content)
+        # mtime 精度不足時可能沿用舊版本,上傳後直接清除
+        template_cache.invalidate(template_path)
         
         logger.info(f"範本上傳成功: {file.filename}")
         
@@ -205,6 +1070,42 @@ class GenerateFromTemplateRequest(BaseModel):
     template_file_path: str
     sections: List[SectionData]
     user_id: str
+    stream_assembly: Optional[bool] = None  # 未指定時章節數 >= STREAM_ASSEMBLY_MIN_SECTIONS 即使用
+
+
+async def load_template_context(request: GenerateFromTemplateRequest):
+    """從 Supabase Storage 取得範本 (未變動時沿用快取,不重新下載) 並組出渲染用的 context"""
+    supabase_url, _ = get_supabase_credentials()
+    template_url = f"{supabase_url}/storage/v1/object/public/{request.template_file_path}"
+    logger.info(f"取得範本: {template_url}")
+
+    template = await remote_template_cache.get(get_http_client(), request.template_file_path, template_url)
+
+    logger.info(f"範本已載入: {len(template.data)} bytes")
+
+    context = {
+        "project_title": request.project_title,
+        "sections": [
+            {
+                "title": section.title,
+                "content": section.content
+            }
+            for section in request.sections
+        ]
+    }
+
+    logger.info(f"填入 {len(request.sections)} 個章節")
+    return template, context
+
+
+def use_stream_assembly(request: GenerateFromTemplateRequest) -> bool:
+    if request.stream_assembly is None:
+        return len(request.sections) >= STREAM_ASSEMBLY_MIN_SECTIONS
+    return request.stream_assembly
+
+
+def generated_filename(request: GenerateFromTemplateRequest) -> str:
+    return f"{request.project_title}_{request.project_id[:8]}.docx"
 
 
 @app.post("/generate-from-template")
@@ -221,107 +1122,473 @@ async def generate_from_template(request: GenerateFromTemplateRequest):
     try:
         logger.info(f"開始生成文件: {request.project_title}")
 
-        # 1. 從 Supabase Storage 下載範本
-        supabase_url = os.getenv("SUPABASE_URL")
-        supabase_key = os.getenv("SUPABASE_SERVICE_KEY")
+        # 1-2. 取得範本、準備章節資料
+        template, context = await load_template_context(request)
 
-        if not supabase_url or not supabase_key:
-            raise HTTPException(
-                status_code=500,
-                detail="Supabase 環境變數未設定"
-            )
+        # 3. 渲染文件 (render_executor);大型建議書以串流組裝逐章寫入暫存檔
+        output = tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPOOL_BYTES, dir=OUTPUT_DIR)
+        try:
+            await run_in_render_executor(render_template_to, template, context, output, use_stream_assembly(request))
+            output_filename = generated_filename(request)
+
+            logger.info(f"文件已生成: {output_filename} ({output.tell()} bytes)")
+
+            # 4. 直接從暫存檔上傳到 Supabase Storage
+            output.seek(0)
+            try:
+                download_url = await upload_generated_file(output_filename, output, DOCX_MEDIA_TYPE)
+            except Exception as e:
+                logger.warning(f"{str(e)}, 返回生成的檔案")
+                # 如果上傳失敗,直接返回檔案 (暫存檔於送出後關閉)
+                return attachment_response(output, output_filename, DOCX_MEDIA_TYPE)
+            output.close()
+        except BaseException:
+            output.close()
+            raise
+
+        logger.info(f"✅ 文件生成成功: {download_url}")
+
+        return {
+            "success": True,
+            "download_url": download_url,
+            "filename": output_filename,
+            "sections_count": len(request.sections)
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"生成文件失敗: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ==================== 批次生成 ====================
+# 投標時一次產生主文件、報價附件、符合性對照表與各式表單:
+# 各文件平行渲染,渲染完即送入共用的 PDF 轉檔池
+
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", "20"))
+
+class BatchJob(BaseModel):
+    template_name: str
+    context: Dict[str, Any] = {}
+    output_format: str = "docx"  # docx 或 pdf
+    filename: Optional[str] = None  # 輸出檔名 (不含副檔名),預設為範本檔名
 
-        # 下載範本檔案
-        template_url = f"{supabase_url}/storage/v1/object/public/{request.template_file_path}"
-        logger.info(f"下載範本: {template_url}")
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(template_url)
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"無法下載範本: {response.status_code}"
-                )
+class GenerateBatchRequest(BaseModel):
+    jobs: List[BatchJob]
+    response_format: str = "zip"  # zip 或 manifest (上傳至 Supabase 並回傳下載連結)
+    batch_id: Optional[str] = None
 
-            # 儲存範本到暫存檔
-            temp_template = tempfile.NamedTemporaryFile(delete=False, suffix=".docx")
-            temp_template.write(response.content)
-            temp_template.close()
 
-        logger.info(f"範本已下載: {temp_template.name}")
+def _batch_filenames(jobs: List[BatchJob]) -> List[str]:
+    """每個 job 的輸出檔名 (不含副檔名),重複時加上序號"""
+    names = []
+    seen = set()
+    for index, job in enumerate(jobs):
+        name = Path(job.filename or job.template_name).name
+        name = name[:-5] if name.lower().endswith(".docx") else name
+        if name in seen:
+            # 加上序號後仍可能與其他 job 指定的檔名相同,遞增直到不重複
+            suffix = index + 1
+            while f"{name}_{suffix}" in seen:
+                suffix += 1
+            name = f"{name}_{suffix}"
+        seen.add(name)
+        names.append(name)
+    return names
 
-        # 2. 載入範本
-        doc = DocxTemplate(temp_template.name)
 
-        # 3. 準備章節資料
-        context = {
-            "project_title": request.project_title,
-            "sections": [
+@app.post("/generate-batch")
+async def generate_batch(request: GenerateBatchRequest):
+    """
+    批次生成多份文件
+
+    Args:
+        request: jobs (範本、資料、輸出格式) 與回傳方式
+
+    Returns:
+        zip: 所有文件打包的 zip 檔
+        manifest: 各文件的 Supabase 下載連結
+    """
+    if not request.jobs:
+        raise HTTPException(status_code=400, detail="jobs 不可為空")
+    if len(request.jobs) > BATCH_MAX_JOBS:
+        raise HTTPException(status_code=400, detail=f"單次最多 {BATCH_MAX_JOBS} 份文件")
+    if request.response_format not in ("zip", "manifest"):
+        raise HTTPException(status_code=400, detail="response_format 只接受 zip 或 manifest")
+    for job in request.jobs:
+        if job.output_format.lower() not in ("docx", "pdf"):
+            raise HTTPException(status_code=400, detail=f"不支援的輸出格式: {job.output_format}")
+    missing = [job.template_name for job in request.jobs if not (TEMPLATES_DIR / job.template_name).exists()]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"範本不存在: {', '.join(missing)}")
+
+    if request.response_format == "manifest":
+        get_supabase_credentials()
+
+    batch_id = request.batch_id or uuid.uuid4().hex
+    names = _batch_filenames(request.jobs)
+    work_dir = create_work_dir("batch_")
+    logger.info(f"批次生成 {batch_id}: {len(request.jobs)} 份文件")
+
+    async def run_job(job: BatchJob, name: str) -> Path:
+        docx_path = work_dir / f"{name}.docx"
+        await run_in_render_executor(render_template_file, TEMPLATES_DIR / job.template_name, job.context, docx_path)
+        if job.output_format.lower() != "pdf":
+            return docx_path
+        pdf_path = docx_path.with_suffix(".pdf")
+        await convert_to_pdf(docx_path, pdf_path)
+        return pdf_path
+
+    try:
+        results = await asyncio.gather(
+            *[run_job(job, name) for job, name in zip(request.jobs, names)],
+            return_exceptions=True
+        )
+        failed = [
+            {"index": index, "template_name": job.template_name, "error": str(result)}
+            for index, (job, result) in enumerate(zip(request.jobs, results))
+            if isinstance(result, Exception)
+        ]
+        if failed:
+            for result in results:
+                if isinstance(result, HTTPException) and result.status_code == 503:
+                    raise result
+            logger.error(f"批次生成 {batch_id} 失敗: {failed}")
+            raise HTTPException(status_code=500, detail={"message": "部分文件生成失敗", "failed": failed})
+
+        if request.response_format == "zip":
+            zip_path = work_dir / f"documents_{batch_id[:8]}.zip"
+            # docx / pdf 本身已壓縮,直接 STORED
+            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as zf:
+                for path in results:
+                    zf.write(path, path.name)
+            logger.info(f"✅ 批次生成完成: {zip_path.name}")
+            return FileResponse(
+                zip_path,
+                media_type="application/zip",
+                filename=zip_path.name,
+                background=BackgroundTask(remove_work_dir, work_dir)
+            )
+
+        urls = await asyncio.gather(*[
+            upload_generated_file(
+                f"batch/{batch_id}/{path.name}",
+                await asyncio.to_thread(path.read_bytes),
+                "application/pdf" if path.suffix == ".pdf" else DOCX_MEDIA_TYPE
+            )
+            for path in results
+        ])
+        remove_work_dir(work_dir)
+        logger.info(f"✅ 批次生成完成: {batch_id}")
+        return {
+            "success": True,
+            "batch_id": batch_id,
+            "documents": [
                 {
-                    "title": section.title,
-                    "content": section.content
+                    "index": index,
+                    "template_name": job.template_name,
+                    "filename": path.name,
+                    "download_url": url
                 }
-                for section in request.sections
+                for index, (job, path, url) in enumerate(zip(request.jobs, results, urls))
             ]
         }
 
-        logger.info(f"填入 {len(request.sections)} 個章節")
+    except HTTPException:
+        remove_work_dir(work_dir)
+        raise
+    except Exception as e:
+        remove_work_dir(work_dir)
+        logger.error(f"批次生成失敗: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # 4. 渲染文件
-        doc.render(context)
 
-        # 5. 儲存生成的文件
-        output_filename = f"{request.project_title}_{request.project_id[:8]}.docx"
-        output_path = OUTPUT_DIR / output_filename
-        doc.save(output_path)
+# ==================== 背景工作 ====================
+# 大型建議書的渲染 + PDF 轉檔可能超過一分鐘:/jobs/* 立即回傳 job_id,
+# 由 JOB_WORKERS 個 worker 在背景執行,用戶端以 GET /jobs/{job_id} 查詢進度,
+# 完成後從 /jobs/{job_id}/result 下載;結果保留 OUTPUT_RETENTION_SECONDS 秒
 
-        logger.info(f"文件已生成: {output_path}")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "100"))
+JOB_PDF_WAIT_SECONDS = int(os.getenv("JOB_PDF_WAIT_SECONDS", "600"))  # 等待 PDF 轉檔佇列的上限,逾時工作失敗
 
-        # 6. 上傳到 Supabase Storage
-        storage_path = f"generated-documents/{output_filename}"
-        upload_url = f"{supabase_url}/storage/v1/object/generated-documents/{output_filename}"
+class GenerationJob:
+    """單一背景工作: 狀態 (queued → rendering → converting / uploading → completed)、進度與結果檔"""
 
-        with open(output_path, "rb") as f:
-            async with httpx.AsyncClient() as client:
-                upload_response = await client.post(
-                    upload_url,
-                    headers={
-                        "Authorization": f"Bearer {supabase_key}",
-                        "Content-Type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                    },
-                    files={"file": f}
-                )
+    def __init__(self, kind: str, run):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"
+        self.progress = 0
+        self.message = "等待中"
+        self.error: Optional[Any] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.work_dir: Optional[Path] = None
+        self.output_path: Optional[Path] = None
+        self.filename: Optional[str] = None
+        self.media_type: Optional[str] = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.finished_at: Optional[float] = None
+        self._run = run
+        self._task: Optional[asyncio.Task] = None
 
-        if upload_response.status_code not in [200, 201]:
-            logger.warning(f"上傳失敗: {upload_response.status_code}, 返回本地檔案")
-            # 如果上傳失敗,返回本地檔案
-            return FileResponse(
-                output_path,
-                media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                filename=output_filename
-            )
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
 
-        # 7. 生成公開下載連結
-        download_url = f"{supabase_url}/storage/v1/object/public/generated-documents/{output_filename}"
+    def update(self, status: str, progress: int, message: str):
+        self.status = status
+        self.progress = progress
+        self.message = message
+        self.updated_at = time.time()
 
-        logger.info(f"✅ 文件生成成功: {download_url}")
+    def section_progress(self, start: int, end: int) -> Callable[[int, int], None]:
+        """章節進度 callback: 渲染進度換算為 start ~ end (於 render 執行緒呼叫,只做屬性設定)"""
+        def report(done: int, total: int):
+            self.progress = start + (end - start) * done // total
+            self.message = f"渲染章節 {done}/{total}"
+            self.updated_at = time.time()
+        return report
+
+    def set_output(self, path: Path, filename: str, media_type: str):
+        self.output_path = path
+        self.filename = filename
+        self.media_type = media_type
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "error": self.error,
+            "result": self.result,
+            "result_url": f"/jobs/{self.id}/result" if self.status == "completed" and self.output_path else None,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+class JobManager:
+    """有上限的背景工作池: 等待中的工作超過 max_pending 即回 503;完成的工作保留 retention 秒"""
+
+    def __init__(self, workers: int, max_pending: int, retention: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retention = retention
+        self.jobs: Dict[str, GenerationJob] = {}
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        for job in self.jobs.values():
+            if job._task is not None:
+                job._task.cancel()
 
-        # 清理暫存檔
-        os.unlink(temp_template.name)
+    def submit(self, kind: str, run) -> GenerationJob:
+        """run(job) 為實際執行的 coroutine function,於 job.work_dir 產生結果"""
+        self.expire()
+        job = GenerationJob(kind, run)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="背景工作佇列已滿,請稍後再試",
+                                headers={"Retry-After": "10"})
+        self.jobs[job.id] = job
+        logger.info(f"背景工作 {job.id} ({kind}) 已排入佇列")
+        return job
+
+    def get(self, job_id: str) -> GenerationJob:
+        self.expire()
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"工作不存在或已過期: {job_id}")
+        return job
+
+    def cancel(self, job: GenerationJob):
+        """取消工作 (執行中的 render / 轉檔會跑完,但不再進行後續步驟);已結束的工作直接刪除結果"""
+        if job.finished:
+            self._discard(job)
+        elif job._task is not None:
+            job._task.cancel()
+        else:
+            job.update("cancelled", job.progress, "已取消")
+            job.finished_at = time.time()
+
+    def expire(self):
+        cutoff = time.time() - self.retention
+        for job in list(self.jobs.values()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                self._discard(job)
+
+    def _discard(self, job: GenerationJob):
+        self.jobs.pop(job.id, None)
+        if job.work_dir is not None:
+            remove_work_dir(job.work_dir)
 
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job.status != "queued":
+                continue
+            # 工作本身另開 task,取消單一工作不會連帶停掉 worker
+            job._task = asyncio.create_task(self._execute(job))
+            await asyncio.wait([job._task])
+
+    async def _execute(self, job: GenerationJob):
+        self.running += 1
+        job.work_dir = create_work_dir("job_")
+        try:
+            await job._run(job)
+            job.update("completed", 100, "完成")
+            self.completed += 1
+            logger.info(f"✅ 背景工作 {job.id} 完成")
+        except asyncio.CancelledError:
+            job.update("cancelled", job.progress, "已取消")
+            remove_work_dir(job.work_dir)
+            logger.info(f"背景工作 {job.id} 已取消")
+        except Exception as e:
+            job.error = e.detail if isinstance(e, HTTPException) else str(e)
+            job.update("failed", job.progress, "失敗")
+            remove_work_dir(job.work_dir)
+            self.failed += 1
+            logger.error(f"背景工作 {job.id} 失敗: {job.error}", exc_info=not isinstance(e, HTTPException))
+        finally:
+            job.finished_at = time.time()
+            self.running -= 1
+
+    def stats(self) -> Dict[str, Any]:
         return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "running": self.running,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "tracked": len(self.jobs),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected
+        }
+
+job_manager = JobManager(JOB_WORKERS, JOB_MAX_PENDING, OUTPUT_RETENTION_SECONDS)
+
+@app.on_event("startup")
+async def start_job_manager():
+    job_manager.start()
+
+@app.on_event("shutdown")
+async def stop_job_manager():
+    job_manager.shutdown()
+
+async def convert_to_pdf_queued(job: GenerationJob, docx_path: Path, pdf_path: Path):
+    """背景工作不需要立即回應: PDF 轉檔佇列已滿時等待後重試;超過 JOB_PDF_WAIT_SECONDS 仍排不進去才讓工作失敗"""
+    deadline = time.monotonic() + JOB_PDF_WAIT_SECONDS
+    while True:
+        try:
+            return await convert_to_pdf(docx_path, pdf_path)
+        except HTTPException as e:
+            if e.status_code != 503:
+                raise
+            delay = int((e.headers or {}).get("Retry-After", "10"))
+            if time.monotonic() + delay > deadline:
+                raise HTTPException(status_code=503,
+                                    detail=f"PDF 轉檔佇列持續滿載,等待超過 {JOB_PDF_WAIT_SECONDS} 秒")
+            job.message = "等待 PDF 轉檔佇列"
+            await asyncio.sleep(delay)
+
+@app.post("/jobs/generate", status_code=202)
+async def submit_generate_job(
+    template_name: str = Form(...),
+    context_json: str = Form(...),
+    output_format: str = Form("docx")  # docx 或 pdf
+):
+    """與 /generate 相同的參數,改為背景執行;回傳 job_id"""
+    template_path, context = load_generate_input(template_name, context_json)
+
+    async def run(job: GenerationJob):
+        docx_path = job.work_dir / f"generated_{template_path.name}"
+        is_pdf = output_format.lower() == "pdf"
+        job.update("rendering", 0, "渲染文件")
+        await run_in_render_executor(render_template_file, template_path, context, docx_path)
+        job.set_output(docx_path, docx_path.name, DOCX_MEDIA_TYPE)
+        if is_pdf:
+            job.update("converting", 50, "PDF 轉檔")
+            pdf_path = docx_path.with_suffix(".pdf")
+            await convert_to_pdf_queued(job, docx_path, pdf_path)
+            job.set_output(pdf_path, pdf_path.name, "application/pdf")
+        job.result = {"filename": job.filename}
+
+    return job_manager.submit("generate", run).to_dict()
+
+@app.post("/jobs/generate-from-template", status_code=202)
+async def submit_generate_from_template_job(request: GenerateFromTemplateRequest):
+    """與 /generate-from-template 相同的參數,改為背景執行;回傳 job_id"""
+    get_supabase_credentials()
+    output_filename = generated_filename(request)
+
+    async def run(job: GenerationJob):
+        job.update("rendering", 0, "取得範本")
+        template, context = await load_template_context(request)
+        output_path = job.work_dir / "generated.docx"
+        job.update("rendering", 5, "渲染文件")
+        with open(output_path, "wb") as output:
+            await run_in_render_executor(render_template_to, template, context, output,
+                                         use_stream_assembly(request), job.section_progress(5, 90))
+        job.set_output(output_path, output_filename, DOCX_MEDIA_TYPE)
+        job.result = {
             "success": True,
-            "download_url": download_url,
+            "download_url": None,
             "filename": output_filename,
             "sections_count": len(request.sections)
         }
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"生成文件失敗: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
+        job.update("uploading", 90, "上傳至 Supabase")
+        try:
+            with open(output_path, "rb") as output:
+                job.result["download_url"] = await upload_generated_file(output_filename, output, DOCX_MEDIA_TYPE)
+        except Exception as e:
+            # 上傳失敗時結果仍可從 /jobs/{job_id}/result 下載
+            logger.warning(f"{str(e)}, 結果保留於背景工作 {job.id}")
+            job.result["upload_error"] = str(e)
+
+    return job_manager.submit("generate-from-template", run).to_dict()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查詢背景工作狀態與進度 (progress: 0-100)"""
+    return job_manager.get(job_id).to_dict()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """下載背景工作的結果檔"""
+    job = job_manager.get(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"工作尚未完成: {job.status}")
+    if job.output_path is None or not job.output_path.exists():
+        raise HTTPException(status_code=410, detail="結果檔已過期")
+    return FileResponse(job.output_path, media_type=job.media_type, filename=job.filename)
 
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """取消進行中的工作,或刪除已完成工作的結果"""
+    job = job_manager.get(job_id)
+    job_manager.cancel(job)
+    return job.to_dict()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,234 @@
+
+"""
+效能基準 / 回歸檢查: 以合成範本 (段落、欄位、合併儲存格表格、圖片) 量測 _process_docx_file
+
+每個案例在獨立子行程中執行,記錄:
+  wall_seconds  解析耗時 (取 repeat 次中最佳值)
+  peak_rss_mb   子行程峰值 RSS
+  output_bytes  JSON 輸出大小
+
+用法:
+  python bench_parse.py                      # 與 baseline 比較,超過門檻即 exit 1
+  python bench_parse.py --update-baseline    # 重新產生 baseline
+  python bench_parse.py --cases small,medium --threshold 0.3
+"""
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import argparse
+import tempfile
+import resource
+import subprocess
+import contextlib
+import docx
+from docx.shared import Pt, Inches
+from docx.enum.table import WD_ROW_HEIGHT_RULE
+from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_BREAK
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+
+sys.path.append("/app")
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+DEFAULT_THRESHOLD = float(os.environ.get("BENCH_THRESHOLD", "0.25"))
+
+# 每個案例重複 units 次「段落 + 表格 + 圖片」單元
+CASES = {
+    "small":  {"units": 5,   "paragraphs": 10, "table_rows": 8,  "table_cols": 4, "images": 1},
+    "medium": {"units": 40,  "paragraphs": 20, "table_rows": 15, "table_cols": 5, "images": 2},
+    "large":  {"units": 150, "paragraphs": 30, "table_rows": 25, "table_cols": 6, "images": 2},
+}
+
+# 忽略小於此絕對差值的變化 (避免小案例的計時雜訊造成誤報)
+MIN_DELTA = {"wall_seconds": 0.05, "peak_rss_mb": 5.0, "output_bytes": 1024}
+
+# ---------- 合成範本 ----------
+
+def make_png(width, height, seed):
+    """產生純色 PNG (不依賴 Pillow);seed 讓每張圖內容不同,避免 python-docx 合併相同圖片"""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    color = bytes(((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256))
+    raw = b"".join(b"\x00" + color * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw))
+            + chunk(b"IEND", b""))
+
+def build_template(spec):
+    doc = docx.Document()
+    image_seed = 0
+    for unit in range(spec["units"]):
+        doc.add_heading(f"第 {unit + 1} 章", level=1)
+        for i in range(spec["paragraphs"]):
+            kind = i % 5
+            if kind == 0:
+                doc.add_paragraph(f"廠商名稱 {unit}-{i}: ______")
+            elif kind == 1:
+                doc.add_paragraph(f"統一編號 {unit}-{i}:【 】")
+            elif kind == 2:
+                doc.add_paragraph(f"請填寫 第 {unit}-{i} 項說明")
+            else:
+                p = doc.add_paragraph(f"一般內文 {unit}-{i} ")
+                p.add_run("粗體").bold = True
+                p.add_run(" 斜體").italic = True
+                p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+
+        for _ in range(spec["images"]):
+            image_seed += 1
+            p = doc.add_paragraph()
+            p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            p.add_run().add_picture(io.BytesIO(make_png(64, 32, image_seed)), width=Inches(1))
+
+        rows, cols = spec["table_rows"], spec["table_cols"]
+        table = doc.add_table(rows=rows, cols=cols)
+        table.style = "Table Grid"
+        for r, row in enumerate(table.rows):
+            for c, cell in enumerate(row.cells):
+                cell.text = f"項目{c}" if r == 0 else f"{unit}-{r}-{c}"
+        # 合併儲存格: 垂直 (vMerge) 與水平 (gridSpan)
+        table.cell(1, 0).merge(table.cell(min(4, rows - 1), 0))
+        table.cell(1, 1).merge(table.cell(1, 2))
+        table.cell(rows - 2, 1).merge(table.cell(rows - 1, min(3, cols - 1)))
+        table.rows[2].height = Pt(20)
+        table.rows[2].height_rule = WD_ROW_HEIGHT_RULE.EXACTLY
+        tcPr = table.cell(0, cols - 1)._tc.get_or_add_tcPr()
+        shd = OxmlElement("w:shd")
+        shd.set(qn("w:fill"), "D9D9D9")
+        tcPr.append(shd)
+        image_seed += 1
+        table.cell(2, cols - 1).paragraphs[0].add_run().add_picture(
+            io.BytesIO(make_png(16, 16, image_seed)), width=Inches(0.3))
+
+        doc.add_paragraph().add_run().add_break(WD_BREAK.PAGE)
+    return doc
+
+# ---------- 單一案例 (子行程) ----------
+
+class _StubBucket:
+    """本地 storage stub: 圖片只留在記憶體,不打 Supabase"""
+    def upload(self, path, data, file_options=None):
+        return None
+
+    def get_public_url(self, path):
+        return f"http://storage.local/{path}"
+
+class _StubStorage:
+    def from_(self, bucket):
+        return _StubBucket()
+
+class _StubClient:
+    storage = _StubStorage()
+
+def run_case(docx_path, repeat):
+    os.environ.setdefault("SUPABASE_URL", "http://storage.local")
+    os.environ.setdefault("SUPABASE_SERVICE_KEY", "bench")
+    import service
+    service.create_client = lambda url, key: _StubClient()
+
+    wall = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = service._process_docx_file(docx_path, os.path.basename(docx_path), "bench")
+        elapsed = time.perf_counter() - start
+        wall = elapsed if wall is None else min(wall, elapsed)
+
+    # Linux 的 ru_maxrss 單位為 KB
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        "wall_seconds": round(wall, 4),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "output_bytes": len(json.dumps(result, ensure_ascii=False).encode("utf-8")),
+        "tables": len(result["tables"]),
+        "images": len(result["images"]),
+        "fields": len(result["fields"]),
+    }
+
+def measure(docx_path, repeat):
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-case", docx_path, "--repeat", str(repeat)],
+        capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"benchmark case failed: {docx_path}\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+# ---------- 比較 ----------
+
+def compare(name, metrics, baseline, threshold):
+    regressions = []
+    for key, min_delta in MIN_DELTA.items():
+        old = baseline.get(key)
+        new = metrics[key]
+        if not old:
+            continue
+        if new > old * (1 + threshold) and new - old > min_delta:
+            regressions.append(f"{name}.{key}: {old} -> {new} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="template-parsing-service benchmark")
+    parser.add_argument("--cases", default=",".join(CASES), help="逗號分隔的案例名稱")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="允許的相對退化比例")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--corpus-dir", help="保留合成範本的目錄 (預設使用暫存目錄)")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.repeat)))
+        return 0
+
+    names = [n.strip() for n in args.cases.split(",") if n.strip()]
+    unknown = [n for n in names if n not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f).get("cases", {})
+
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_dir = args.corpus_dir or tmp
+        os.makedirs(corpus_dir, exist_ok=True)
+
+        print(f"{'case':<10}{'docx (KB)':>12}{'wall (s)':>12}{'peak RSS (MB)':>16}{'output (KB)':>14}")
+        for name in names:
+            docx_path = os.path.join(corpus_dir, f"bench_{name}.docx")
+            build_template(CASES[name]).save(docx_path)
+            metrics = measure(docx_path, args.repeat)
+            metrics["docx_bytes"] = os.path.getsize(docx_path)
+            results[name] = metrics
+            print(f"{name:<10}{metrics['docx_bytes'] / 1024:>12.0f}{metrics['wall_seconds']:>12.3f}"
+                  f"{metrics['peak_rss_mb']:>16.1f}{metrics['output_bytes'] / 1024:>14.0f}")
+            if name in baseline:
+                regressions.extend(compare(name, metrics, baseline[name], args.threshold))
+
+    if args.update_baseline or not baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "cases": results}, f, indent=2)
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"\nFAILURE: regressions beyond {args.threshold * 100:.0f}%:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"\nSUCCESS: no regressions beyond {args.threshold * 100:.0f}%.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+
+"""
+Microbenchmark: 圖片 / 分頁標記的 XML 搜尋
+比較舊版 (iterdescendants + Python 端 tag 字串比對) 與 tag 過濾 iter() / 預編譯 XPath
+
+用法: python bench_xml_discovery.py [目標節點數,預設 100000]
+"""
+import io
+import os
+import sys
+import time
+import base64
+import docx
+from docx.shared import Inches
+from docx.enum.text import WD_BREAK
+
+sys.path.append("/app")
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    from service import discover_image_elements, find_temp_img_id, XPATH_HAS_PAGE_BREAK, W_TR
+except ImportError as e:
+    print(f"Import Error: {e}")
+    sys.exit(1)
+
+# 1x1 PNG
+PNG_BYTES = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+def build_document(target_nodes):
+    """產生約 target_nodes 個 XML 節點的文件 (段落、表格、圖片、分頁)"""
+    doc = docx.Document()
+    body = doc.element.body
+    block = 0
+    while sum(1 for _ in body.iter()) < target_nodes:
+        for i in range(20):
+            p = doc.add_paragraph(f"段落 {block}-{i} ")
+            p.add_run("bold").bold = True
+        doc.add_paragraph().add_run().add_picture(io.BytesIO(PNG_BYTES), width=Inches(0.5))
+        table = doc.add_table(rows=8, cols=4)
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = f"{block}"
+        table.cell(7, 3).paragraphs[0].runs[0].add_break(WD_BREAK.PAGE)
+        table.cell(3, 1).paragraphs[0].add_run().add_picture(io.BytesIO(PNG_BYTES), width=Inches(0.2))
+        block += 1
+    return doc
+
+# ---------- 舊版實作 (對照組) ----------
+
+def get_local_tag(tag):
+    return tag.split('}')[-1]
+
+def legacy_discover(doc):
+    found = []
+    for elem in doc.element.body.iterdescendants():
+        tag = get_local_tag(elem.tag)
+        if tag not in ['drawing', 'pict']:
+            continue
+        rId = None
+        for child in elem.iterdescendants():
+            if get_local_tag(child.tag) == 'blip':
+                for k, v in child.attrib.items():
+                    if k.endswith('embed') or k.endswith('link') or k.endswith('id'):
+                        rId = v
+                        break
+                if rId: break
+        for child in elem.iterdescendants():
+            if get_local_tag(child.tag) == 'extent':
+                break
+        for child in elem.iterdescendants():
+            if child.tag.endswith('anchor'):
+                break
+        p_element = elem
+        while p_element is not None and not p_element.tag.endswith('}p'):
+            p_element = p_element.getparent()
+        para_index = -1
+        for idx, para in enumerate(doc.paragraphs):
+            if para._element is p_element:
+                para_index = idx
+                break
+        found.append((rId, para_index))
+    return found
+
+def legacy_temp_img_id(elem):
+    img_id = elem.get('temp_img_id')
+    if not img_id:
+        for d in elem.iterdescendants():
+            if d.get('temp_img_id'):
+                return d.get('temp_img_id')
+    return img_id
+
+def legacy_has_page_break(row):
+    for d in row.iterdescendants():
+        if get_local_tag(d.tag) == 'lastRenderedPageBreak':
+            return True
+        if get_local_tag(d.tag) == 'br' and d.get('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}type') == 'page':
+            return True
+    return False
+
+# ---------- 量測 ----------
+
+def best_of(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def run_benchmark(target_nodes, repeat=3):
+    doc = build_document(target_nodes)
+    body = doc.element.body
+    node_count = sum(1 for _ in body.iter())
+    runs = list(body.iter('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}r'))
+    rows = list(body.iter(W_TR))
+    print(f"Document: {node_count} XML nodes, {len(runs)} runs, {len(rows)} table rows")
+
+    # 標記圖片 (模擬 extract_images_from_doc),讓 temp_img_id 查找有結果
+    for i, found in enumerate(discover_image_elements(doc)):
+        found["elem"].set('temp_img_id', f"img_{i}")
+
+    cases = [
+        ("image discovery + para index", lambda: legacy_discover(doc),
+         lambda: [(f["rId"], f["p_element"]) for f in discover_image_elements(doc)]),
+        ("temp_img_id lookup (per run)", lambda: [legacy_temp_img_id(r) for r in runs],
+         lambda: [find_temp_img_id(r) for r in runs]),
+        ("table row page breaks", lambda: [legacy_has_page_break(r) for r in rows],
+         lambda: [XPATH_HAS_PAGE_BREAK(r) for r in rows]),
+    ]
+
+    print(f"\n{'case':<32}{'legacy (ms)':>14}{'lxml (ms)':>14}{'speedup':>10}")
+    for name, legacy_fn, new_fn in cases:
+        legacy_time, legacy_result = best_of(legacy_fn, repeat)
+        new_time, new_result = best_of(new_fn, repeat)
+        assert len(legacy_result) == len(new_result), f"{name}: result count mismatch"
+        print(f"{name:<32}{legacy_time * 1000:>14.1f}{new_time * 1000:>14.1f}{legacy_time / new_time:>9.1f}x")
+
+if __name__ == "__main__":
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -3,25 +3,54 @@ Word 範本解析服務
 功能: 自動識別 Word 文件中的可填寫欄位,生成動態表單 Schema
 """
 
+import io
 import os
 import re
 import json
+import time
+import copy
+import hashlib
+import zipfile
+import posixpath
 import uuid
+import asyncio
+import threading
+import multiprocessing
+import cProfile
+import pstats
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from difflib import SequenceMatcher
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple, Union
+from typing import List, Dict, Any, Optional, Tuple, Union, Callable, Iterator, IO
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from docx import Document
 from docx.shared import Pt, RGBColor, Length
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_BREAK
 from docx.enum.shape import WD_INLINE_SHAPE
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
 from docx.oxml.text.paragraph import CT_P
 from docx.oxml.table import CT_Tbl
-from docx.oxml.ns import qn
+from docx.oxml.ns import qn, nsmap
+from docx.oxml import OxmlElement
+from docx.oxml.parser import element_class_lookup as oxml_element_class_lookup
+from docx.table import Table, _Cell
+from docx.text.paragraph import Paragraph
 from docx.text.run import Run
+from lxml import etree
 from supabase import create_client, Client
 
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:  # 未安裝 Pillow 時不產生網頁版本與縮圖
+    Image = None
+
 app = FastAPI(title="Template Parsing Service")
 
 # ==================== 數據模型 ====================
@@ -87,8 +116,77 @@ class TemplateSchema(BaseModel):
     structure: List[Dict[str, Any]] # 完整文件結構順序
     styles: Dict[str, Any]
 
+TEMPLATE_STYLES = {
+    "default_font": "微軟正黑體",
+    "default_size": 12,
+    "note": "Enhanced python-docx extraction (v2) with Images & Structure"
+}
+
+# 解析出的圖片上傳到的 bucket
+IMAGE_BUCKET = "generated-documents"
+
+# 圖片網頁版本與縮圖 (原圖常是數 MB 的 EMF/TIFF/未壓縮 PNG,編輯器只需要網頁尺寸)
+IMAGE_VARIANTS = os.environ.get("TEMPLATE_IMAGE_VARIANTS", "true").lower() == "true"
+WEB_IMAGE_MAX_PX = int(os.environ.get("TEMPLATE_WEB_IMAGE_MAX_PX", 1600))
+THUMBNAIL_MAX_PX = int(os.environ.get("TEMPLATE_THUMBNAIL_MAX_PX", 256))
+WEB_IMAGE_QUALITY = 80
+
 # ==================== 核心解析邏輯 ====================
 
+# 常用 OOXML 標籤 (預先計算 qn,避免在逐格迴圈中重複組字串)
+W_VAL = qn('w:val')
+W_W = qn('w:w')
+W_TYPE = qn('w:type')
+W_FILL = qn('w:fill')
+W_TR = qn('w:tr')
+W_TRPR = qn('w:trPr')
+W_GRID_BEFORE = qn('w:gridBefore')
+W_TC = qn('w:tc')
+W_TCPR = qn('w:tcPr')
+W_TCW = qn('w:tcW')
+W_GRID_SPAN = qn('w:gridSpan')
+W_VMERGE = qn('w:vMerge')
+W_SHD = qn('w:shd')
+W_VALIGN = qn('w:vAlign')
+W_TEXT_DIRECTION = qn('w:textDirection')
+W_JC = qn('w:jc')
+W_NUMPR = qn('w:numPr')
+W_TBL_BORDERS = qn('w:tblBorders')
+W_TBL_W = qn('w:tblW')
+W_TBL_IND = qn('w:tblInd')
+W_TBL = qn('w:tbl')
+W_P = qn('w:p')
+W_PPR = qn('w:pPr')
+W_R = qn('w:r')
+W_T = qn('w:t')
+W_BR = qn('w:br')
+W_TAB = qn('w:tab')
+W_LAST_RENDERED_PAGE_BREAK = qn('w:lastRenderedPageBreak')
+W_DRAWING = qn('w:drawing')
+W_PICT = qn('w:pict')
+A_BLIP = qn('a:blip')
+WP_EXTENT = qn('wp:extent')
+WP_ANCHOR = qn('wp:anchor')
+WP_ALIGN = qn('wp:align')
+V_IMAGEDATA = '{urn:schemas-microsoft-com:vml}imagedata'
+
+# 預先編譯的 XPath (在 lxml 的 C 端完成搜尋)
+XPATH_HAS_PAGE_BREAK = etree.XPath(
+    'boolean(.//w:lastRenderedPageBreak | .//w:br[@w:type="page"])',
+    namespaces={'w': nsmap['w']}
+)
+# 段落分頁: pageBreakBefore (ST_OnOff, 未設 val 視為 true) 或 run 內的分頁 br
+XPATH_PARA_PAGE_BREAK = etree.XPath(
+    'boolean(./w:pPr/w:pageBreakBefore[not(@w:val="0" or @w:val="false" or @w:val="off")]'
+    ' | ./w:r//w:br[@w:type="page"])',
+    namespaces={'w': nsmap['w']}
+)
+
+# 可填寫欄位偵測: 單一預編譯 regex,以群組名稱區分樣式 (優先順序 underline > bracket > keyword)
+FIELD_PATTERN = re.compile(r'(?P<underline>_{3,})|(?P<bracket>【\s*】|〔\s*〕)|(?P<keyword>請填寫|填寫說明|說明[::])')
+UNDERLINE_LABEL_PATTERN = re.compile(r'(.+?)[::]?\s*_{3,}')
+BRACKET_LABEL_PATTERN = re.compile(r'(.+?)[::]?\s*【\s*】')
+
 def get_length_in_points(length_obj) -> Optional[float]:
     if length_obj is None:
         return None
@@ -174,81 +272,185 @@ def extract_paragraph_style(para) -> Dict[str, Any]:
     return style
 
 def check_page_breaks(para) -> bool:
-    if para.paragraph_format.page_break_before:
-        return True
-    for run in para.runs:
-        if 'w:br' in run.element.xml and 'type="page"' in run.element.xml:
-             return True
-        brs = run.element.findall(qn('w:br'))
-        for br in brs:
-            if br.get(qn('w:type')) == 'page':
-                return True
-    return False
-
-def extract_images_from_doc(doc: Document, template_id: str) -> List[Dict[str, Any]]:
+    """段前分頁或 run 內的 w:br type="page" (直接查元素樹,不序列化 run XML)"""
+    return XPATH_PARA_PAGE_BREAK(para._p)
+
+def discover_image_elements(doc: Document) -> List[Dict[str, Any]]:
+    """
+    找出 body 中所有圖片容器 (w:drawing 新式 / w:pict 舊式),不上傳
+    以 tag 過濾的 iter() 在 lxml (C) 端完成篩選,避免在 Python 端逐節點比對 tag 字串
+    Returns:
+        依文件順序的描述: elem, tag, rId, width, height, p_element, is_floating, floating_align
+    """
+    found = []
+    for elem in doc.element.body.iter(W_DRAWING, W_PICT):
+        rId = None
+        width_pt = 0
+        height_pt = 0
+
+        if elem.tag == W_DRAWING:
+            # Find blip, check attribs aggressively (r:embed / r:link / r:id)
+            for blip in elem.iter(A_BLIP):
+                for k, v in blip.attrib.items():
+                    if k.endswith('embed') or k.endswith('link') or k.endswith('id'):
+                        rId = v
+                        break
+                if rId: break
+
+            # Dimensions
+            extent = next(elem.iter(WP_EXTENT), None)
+            if extent is not None:
+                width_pt = int(extent.get('cx', 0)) / 12700
+                height_pt = int(extent.get('cy', 0)) / 12700
+        else:
+            # Find imagedata
+            for imagedata in elem.iter(V_IMAGEDATA):
+                for k, v in imagedata.attrib.items():
+                    if k.endswith('id'):
+                        rId = v
+                        break
+                if rId: break
+            # Dimensions logic omitted for brevity, handled by frontend auto-size
+
+        # Check for Floating Alignment (wp:anchor -> wp:positionH -> wp:align)
+        is_floating = False
+        floating_align = None
+        anchor = next(elem.iter(WP_ANCHOR), None)
+        if anchor is not None:
+            is_floating = True
+            align = next(anchor.iter(WP_ALIGN), None)
+            if align is not None and align.text in ['center', 'right', 'left']:
+                floating_align = align.text
+
+        found.append({
+            "elem": elem,
+            "tag": get_local_tag(elem.tag),
+            "rId": rId,
+            "width": width_pt,
+            "height": height_pt,
+            # Find parent paragraph
+            "p_element": next(elem.iterancestors(W_P), None),
+            "is_floating": is_floating,
+            "floating_align": floating_align
+        })
+    return found
+
+def find_temp_img_id(elem) -> Optional[str]:
+    """elem 本身或其子孫上的 temp_img_id (由 extract_images_from_doc 標記)"""
+    img_id = elem.get('temp_img_id')
+    if img_id:
+        return img_id
+    # 標記只會出現在 drawing / pict 上,以 tag 過濾的 iter() 跳過其他節點
+    for container in elem.iter(W_DRAWING, W_PICT):
+        img_id = container.get('temp_img_id')
+        if img_id:
+            return img_id
+    return None
+
+def build_image_variants(image_bytes: bytes) -> Dict[str, Dict[str, Any]]:
+    """
+    產生網頁版本 (最長邊 WEB_IMAGE_MAX_PX) 與縮圖 (THUMBNAIL_MAX_PX),WebP 優先,不支援時用 PNG
+    Pillow 無法解碼的格式 (例如非 Windows 上的 EMF/WMF) 回傳空 dict
+    網頁版本若未縮小且不比原圖小,則省略 (直接用原圖)
+    Returns:
+        {"web": {...}, "thumbnail": {...}},各為 {"data", "content_type", "ext", "width", "height"}
+    """
+    if Image is None:
+        return {}
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as source:
+            source.seek(0)  # 多頁 TIFF / 動態 GIF 只取第一張
+            img = ImageOps.exif_transpose(source)
+            img.load()
+    except Exception as e:
+        print(f"Image variants skipped: {e}")
+        return {}
+
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    img = img.convert("RGBA" if has_alpha else "RGB")
+    use_webp = pil_features.check("webp")
+
+    variants = {}
+    for name, max_px in (("web", WEB_IMAGE_MAX_PX), ("thumbnail", THUMBNAIL_MAX_PX)):
+        resized = img.copy()
+        resized.thumbnail((max_px, max_px), Image.LANCZOS)
+        buffer = io.BytesIO()
+        if use_webp:
+            resized.save(buffer, "WEBP", quality=WEB_IMAGE_QUALITY, method=4)
+            content_type, ext = "image/webp", "webp"
+        else:
+            resized.save(buffer, "PNG", optimize=True)
+            content_type, ext = "image/png", "png"
+        data = buffer.getvalue()
+        if name == "web" and resized.size == img.size and len(data) >= len(image_bytes):
+            continue
+        variants[name] = {
+            "data": data,
+            "content_type": content_type,
+            "ext": ext,
+            "width": resized.width,
+            "height": resized.height
+        }
+    return variants
+
+def upload_image_variants(supabase: Client, original_path: str, image_bytes: bytes,
+                          profiler: Optional["ParseProfiler"] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    產生並上傳圖片的網頁版本與縮圖,存放在原圖旁 ({原檔名}_web.webp / {原檔名}_thumbnail.webp)
+    Returns:
+        {"web": {"url", "content_type", "width", "height", "size_bytes"}, "thumbnail": {...}}
+    """
+    with _stage(profiler, "image_variants"):
+        variants = build_image_variants(image_bytes)
+
+    base_path = os.path.splitext(original_path)[0]
+    uploaded = {}
+    for name, variant in variants.items():
+        path = f"{base_path}_{name}.{variant['ext']}"
+        with _stage(profiler, "supabase_upload"):
+            supabase.storage.from_(IMAGE_BUCKET).upload(path, variant["data"], {
+                "content-type": variant["content_type"],
+                "upsert": "true"
+            })
+            url = supabase.storage.from_(IMAGE_BUCKET).get_public_url(path)
+        uploaded[name] = {
+            "url": url,
+            "content_type": variant["content_type"],
+            "width": variant["width"],
+            "height": variant["height"],
+            "size_bytes": len(variant["data"])
+        }
+    return uploaded
+
+def extract_images_from_doc(doc: Document, template_id: str, profiler: Optional["ParseProfiler"] = None,
+                            lazy: bool = False) -> List[Dict[str, Any]]:
+    """
+    lazy=True: 不上傳圖片,只記錄描述 (rId、內容雜湊、大小),url 為 None,
+    需要顯示時再由 /materialize-images 產生 (見 materialize_images)
+    """
     images = []
     supabase_url = os.environ.get("SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_SERVICE_KEY")
     
-    if not supabase_url or not supabase_key:
+    if not lazy and (not supabase_url or not supabase_key):
         print("Warning: Supabase credentials missing. Image extraction skipped.")
         return []
 
-    # Map paragraph objects to their index for quick lookup
-    # We will use ID or element reference to match better
+    # Map body-level paragraph elements to their index in doc.paragraphs
+    body_para_index = {p: idx for idx, p in enumerate(doc.element.body.iterchildren(W_P))}
+    
+    # 同一個圖片 part 被多次引用時,網頁版本與縮圖只產生一次
+    variants_by_part = {}
     
     try:
-        supabase: Client = create_client(supabase_url, supabase_key)
-        bucket_name = "generated-documents"
+        supabase: Optional[Client] = None if lazy else create_client(supabase_url, supabase_key)
+        bucket_name = IMAGE_BUCKET
         
-        # Helper to get local tag name without namespace
-        def get_local_tag(tag):
-             return tag.split('}')[-1]
-        # Iterate ALL descendants to find potential image containers
-        # We look for 'drawing' (modern) and 'pict' (legacy/fallback)
-        for i, elem in enumerate(doc.element.body.iterdescendants()):
-            tag = get_local_tag(elem.tag)
-            
-            if tag not in ['drawing', 'pict']:
-                continue
-                
+        for found in discover_image_elements(doc):
+            elem = found["elem"]
+            tag = found["tag"]
             try:
-                rId = None
-                width_pt = 0
-                height_pt = 0
-                
-                if tag == 'drawing':
-                    # Find blip (ignoring namespace via tag name)
-                    for child in elem.iterdescendants():
-                        if get_local_tag(child.tag) == 'blip':
-                            # Check attribs aggressively
-                            for k, v in child.attrib.items():
-                                if k.endswith('embed') or k.endswith('link') or k.endswith('id'):
-                                    rId = v
-                                    break
-                            if rId: break
-                            
-                    # Dimensions
-                    for child in elem.iterdescendants():
-                        if get_local_tag(child.tag) == 'extent':
-                            cx = int(child.get('cx', 0))
-                            cy = int(child.get('cy', 0))
-                            width_pt = cx / 12700
-                            height_pt = cy / 12700
-                            break
-                            
-                elif tag == 'pict':
-                    # Find imagedata
-                    for child in elem.iterdescendants():
-                        if get_local_tag(child.tag) == 'imagedata':
-                             for k, v in child.attrib.items():
-                                if k.endswith('id'):
-                                    rId = v
-                                    break
-                             if rId: break
-                    
-                    # Dimensions logic omitted for brevity, handled by frontend auto-size
-
+                rId = found["rId"]
                 if not rId or rId not in doc.part.related_parts:
                     continue
                     
@@ -256,26 +458,29 @@ def extract_images_from_doc(doc: Document, template_id: str) -> List[Dict[str, A
                 image_bytes = image_part.blob
                 content_type = image_part.content_type
                 
-                ext = content_type.split('/')[-1] if '/' in content_type else 'png'
-                filename = f"parsed_image_{uuid.uuid4()}.{ext}"
-                path = f"template_assets/{template_id}/{filename}"
-                
-                supabase.storage.from_(bucket_name).upload(path, image_bytes, {
-                    "content-type": content_type,
-                    "upsert": "false"
-                })
-                
-                public_url = supabase.storage.from_(bucket_name).get_public_url(path)
-                
-                # Find parent paragraph using tag check instead of isinstance(CT_P)
-                # This avoids import/proxy class issues
-                p_element = elem
-                while p_element is not None and not p_element.tag.endswith('}p'):
-                    p_element = p_element.getparent()
+                if lazy:
+                    public_url = None
+                else:
+                    ext = content_type.split('/')[-1] if '/' in content_type else 'png'
+                    filename = f"parsed_image_{uuid.uuid4()}.{ext}"
+                    path = f"template_assets/{template_id}/{filename}"
+
+                    with _stage(profiler, "supabase_upload"):
+                        supabase.storage.from_(bucket_name).upload(path, image_bytes, {
+                            "content-type": content_type,
+                            "upsert": "false"
+                        })
+
+                        public_url = supabase.storage.from_(bucket_name).get_public_url(path)
+
+                    if IMAGE_VARIANTS and image_part.partname not in variants_by_part:
+                        variants_by_part[image_part.partname] = upload_image_variants(supabase, path, image_bytes, profiler)
                 
                 # Mark paragraph with temp_id for robust matching
+                p_element = found["p_element"]
                 para_temp_id = None
                 alignment = None
+                para_index = -1
                 if p_element is not None:
                     para_temp_id = p_element.get('temp_id')
                     if not para_temp_id:
@@ -283,58 +488,22 @@ def extract_images_from_doc(doc: Document, template_id: str) -> List[Dict[str, A
                         p_element.set('temp_id', para_temp_id)
                     
                     # Try to find alignment from pPr -> jc
-                    # p_element is a CT_P
-                    pPr = p_element.find(qn('w:pPr'))
+                    pPr = p_element.find(W_PPR)
                     if pPr is not None:
-                         jc = pPr.find(qn('w:jc'))
+                         jc = pPr.find(W_JC)
                          if jc is not None:
-                             alignment = jc.get(qn('w:val'))
+                             alignment = jc.get(W_VAL)
 
-                # Find matching paragraph index in doc.paragraphs
-                para_index = -1
-                if p_element is not None:
-                    for idx, para in enumerate(doc.paragraphs):
-                        # Use temp_id for matching
-                        if para._element.get('temp_id') == para_temp_id:
-                            para_index = idx
-                            # Robust Alignment Extraction using python-docx
-                            # This handles direction formatting + style inheritance
-                            try:
-                                if para.alignment == WD_ALIGN_PARAGRAPH.CENTER:
-                                    alignment = 'center'
-                                elif para.alignment == WD_ALIGN_PARAGRAPH.RIGHT:
-                                    alignment = 'right'
-                                elif para.alignment == WD_ALIGN_PARAGRAPH.JUSTIFY:
-                                    alignment = 'justify'
-                                elif para.alignment == WD_ALIGN_PARAGRAPH.LEFT:
-                                    alignment = 'left'
-                            except:
-                                pass
-                            break
-                
-                # Check for Floating Alignment (wp:anchor -> wp:positionH -> wp:align)
-                # elem is drawing/pict.
-                is_floating = False
-                floating_align = None
-                try:
-                    # Search specifically for wp:anchor
-                    # drawing -> anchor
-                    for child in elem.iterdescendants():
-                         if child.tag.endswith('anchor'):
-                             is_floating = True
-                             # Look for align
-                             for grand in child.iterdescendants():
-                                 if grand.tag.endswith('align'):
-                                     if grand.text in ['center', 'right', 'left']:
-                                         floating_align = grand.text
-                                     break
-                             break
-                except:
-                    pass
+                    # Find matching paragraph index in doc.paragraphs (body-level only)
+                    para_index = body_para_index.get(p_element, -1)
+                    if para_index >= 0 and alignment == 'both':
+                        # Same mapping as python-docx WD_ALIGN_PARAGRAPH.JUSTIFY
+                        alignment = 'justify'
 
                 # If floating align found, OVERRIDE paragraph alignment
-                if floating_align:
-                    alignment = floating_align
+                if found["floating_align"]:
+                    alignment = found["floating_align"]
+                is_floating = found["is_floating"]
 
                 img_id = str(uuid.uuid4())
                 
@@ -347,8 +516,8 @@ def extract_images_from_doc(doc: Document, template_id: str) -> List[Dict[str, A
                 images.append({
                     "id": img_id,
                     "url": public_url,
-                    "width": width_pt,
-                    "height": height_pt,
+                    "width": found["width"],
+                    "height": found["height"],
                     "index": len(images), 
                     "paragraph_index": para_index,
                     "para_temp_id": para_temp_id, 
@@ -356,7 +525,16 @@ def extract_images_from_doc(doc: Document, template_id: str) -> List[Dict[str, A
                     "content_type": content_type,
                     "is_floating": is_floating
                 })
-                print(f"Uploaded image to {public_url} (para_index: {para_index}, temp_id: {para_temp_id})")
+                if lazy:
+                    images[-1].update({
+                        "rId": rId,
+                        "content_hash": hashlib.sha256(image_bytes).hexdigest(),
+                        "size_bytes": len(image_bytes)
+                    })
+                else:
+                    if IMAGE_VARIANTS:
+                        images[-1]["variants"] = variants_by_part[image_part.partname]
+                    print(f"Uploaded image to {public_url} (para_index: {para_index}, temp_id: {para_temp_id})")
                 
             except Exception as e:
                 print(f"Failed to process image element {tag}: {e}")
@@ -371,24 +549,26 @@ def extract_images_from_doc(doc: Document, template_id: str) -> List[Dict[str, A
     return images
 
 def detect_fillable_fields(doc: Document) -> List[Dict[str, Any]]:
-    # ... (Keep existing logic, omitted for brevity if unchanged, but included below for safety)
-    # Actually user said "parsed_fields" is empty too. Let's keep existing logic but maybe it's too strict?
-    # User's template might just be normal text.
-    # For now we reuse the existing logic, but structure builder will handle the rest.
+    """
+    直接在段落元素上偵測可填寫欄位,只有符合的段落才計算樣式與分頁
+    """
     fields = []
     field_counter = 1
     
-    for para_idx, para in enumerate(doc.paragraphs):
-        text = para.text.strip()
+    for para_idx, p in enumerate(doc.element.body.iterchildren(W_P)):
+        text = p.text.strip()
+        kinds = {m.lastgroup for m in FIELD_PATTERN.finditer(text)}
+        if not kinds:
+            continue
+
+        para = Paragraph(p, doc._body)
         para_style = extract_paragraph_style(para)
-        
         has_break = check_page_breaks(para)
         if has_break:
             para_style["has_page_break"] = True
         
-        # Original regex logic
-        if re.search(r'_{3,}', text):
-            match = re.match(r'(.+?)[::]?\s*_{3,}', text)
+        if 'underline' in kinds:
+            match = UNDERLINE_LABEL_PATTERN.match(text)
             label = match.group(1).strip() if match else f"欄位 {field_counter}"
             fields.append({
                 "name": f"field_{field_counter}",
@@ -399,9 +579,8 @@ def detect_fillable_fields(doc: Document) -> List[Dict[str, Any]]:
                 "position": {"paragraph_index": para_idx, "pattern": "underline", "has_page_break": has_break},
                 "style": para_style
             })
-            field_counter += 1
-        elif re.search(r'【\s*】|〔\s*〕', text):
-            match = re.match(r'(.+?)[::]?\s*【\s*】', text)
+        elif 'bracket' in kinds:
+            match = BRACKET_LABEL_PATTERN.match(text)
             label = match.group(1).strip() if match else f"欄位 {field_counter}"
             fields.append({
                 "name": f"field_{field_counter}",
@@ -412,8 +591,7 @@ def detect_fillable_fields(doc: Document) -> List[Dict[str, Any]]:
                 "position": {"paragraph_index": para_idx, "pattern": "bracket", "has_page_break": has_break},
                 "style": para_style
             })
-            field_counter += 1
-        elif re.search(r'(請填寫|填寫說明|說明[::])', text, re.IGNORECASE):
+        else:
             label = text.replace("請填寫", "").replace("填寫說明", "").replace(":", "").strip()
             fields.append({
                 "name": f"field_{field_counter}",
@@ -424,311 +602,331 @@ def detect_fillable_fields(doc: Document) -> List[Dict[str, Any]]:
                 "position": {"paragraph_index": para_idx, "pattern": "keyword", "has_page_break": has_break},
                 "style": para_style
             })
-            field_counter += 1
+        field_counter += 1
     
     return fields
 
-def detect_fillable_tables(doc: Document, images: List[Dict] = []) -> List[Dict[str, Any]]:
+def build_table_grid(tbl) -> List[List[Dict[str, Any]]]:
+    """
+    一次讀取 w:tbl,建立以 layout grid 為單位的儲存格矩陣 (唯讀,不修改文件)
+    - 水平合併 (gridSpan) 的儲存格在每個 grid 欄位重複出現
+    - vMerge=continue 的儲存格解析到上方的起始儲存格
+    行為與 python-docx 的 row.cells 一致,但不需每次重新計算 grid
+    Returns:
+        rows: 每列為 slot 清單,slot 為共用的儲存格 dict (tc, tcPr, colSpan, vMerge)
+    """
+    grid = []
+    prev_by_offset = {}
+    for tr in tbl.iterchildren(W_TR):
+        slots = []
+        cur_by_offset = {}
+        offset = 0
+        trPr = tr.find(W_TRPR)
+        if trPr is not None:
+            gridBefore = trPr.find(W_GRID_BEFORE)
+            if gridBefore is not None:
+                offset = int(gridBefore.get(W_VAL, 0))
+
+        for tc in tr.iterchildren(W_TC):
+            tcPr = tc.find(W_TCPR)
+            gridSpan = tcPr.find(W_GRID_SPAN) if tcPr is not None else None
+            span = int(gridSpan.get(W_VAL)) if gridSpan is not None else 1
+            vMerge = tcPr.find(W_VMERGE) if tcPr is not None else None
+            vMergeVal = (vMerge.get(W_VAL) or "continue") if vMerge is not None else None
+
+            cell = None
+            if vMergeVal == "continue":
+                # Delegate to the root cell of the vertical span (same as python-docx)
+                cell = prev_by_offset.get(offset)
+            if cell is None:
+                cell = {"tc": tc, "tcPr": tcPr, "colSpan": span, "vMerge": vMergeVal}
+
+            for k in range(cell["colSpan"]):
+                slots.append(cell)
+            for k in range(span):
+                cur_by_offset[offset + k] = cell
+            offset += span
+
+        grid.append(slots)
+        prev_by_offset = cur_by_offset
+    return grid
+
+def _extract_grid_cell(cell: Dict[str, Any], table, images: List[Dict]) -> Dict[str, Any]:
+    """解析單一 (根) 儲存格的內容與格式,結果快取在 cell dict 上供重複的 slot 共用"""
+    info = cell.get("_info")
+    if info is not None:
+        return info
+
+    tcPr = cell["tcPr"]
+    paragraphs = _Cell(cell["tc"], table).paragraphs
+    text = "\n".join(p.text for p in paragraphs).strip()
+
+    cell_format = {}
+    overrides = {}
+    if tcPr is not None:
+        # Cell shading/background
+        shd = tcPr.find(W_SHD)
+        if shd is not None:
+            fill = shd.get(W_FILL)
+            if fill and fill != "auto":
+                cell_format["backgroundColor"] = fill
+
+        # Vertical Alignment
+        vAlign = tcPr.find(W_VALIGN)
+        if vAlign is not None:
+            val = vAlign.get(W_VAL)
+            # Map DOCX 'center' to CSS 'middle'
+            cell_format["vAlign"] = "middle" if val == 'center' else val
+
+        # Text Direction (Vertical Text)
+        # e.g. tbRl (top to bottom, right to left) -> vertical-rl
+        textDirection = tcPr.find(W_TEXT_DIRECTION)
+        if textDirection is not None and textDirection.get(W_VAL) in ['tbRl', 'btLr']:
+            cell_format["textDirection"] = "vertical-rl" # Simplified mapping
+            cell_format["writingMode"] = "vertical-rl"
+
+        # Specific Cell Overrides (tcBorders)
+        overrides = extract_cell_borders(tcPr)
+
+    # Runs extraction for the cell
+    cell_runs = []
+    cell_h_align = None
+    for p_idx, p in enumerate(paragraphs):
+        pPr = p._element.pPr
+
+        # 1. Determine Horizontal Alignment (First paragraph wins usually)
+        if cell_h_align is None and pPr is not None:
+            jc = pPr.find(W_JC)
+            if jc is not None:
+                val = jc.get(W_VAL)
+                if val in ('center', 'right', 'both'): # Frontend uses 'both' for justify
+                    cell_h_align = val
+
+        # 2. Handle Line Breaks (Between paragraphs)
+        if p_idx > 0:
+            cell_runs.append({
+                "text": "\n",
+                "type": "text",
+                "format": {}
+            })
+
+        # 3. Runs Extraction (Supports Inline Images)
+        p_runs = extract_runs(p, images)
+
+        # 4. Check for Numbering (Bullets)
+        if pPr is not None and pPr.find(W_NUMPR) is not None:
+            p_runs.insert(0, {
+                "text": "• ",
+                "format": p_runs[0]['format'] if p_runs else {}
+            })
+
+        cell_runs.extend(p_runs)
+
+    info = {
+        "text": text,
+        "runs": cell_runs,
+        "format": cell_format,
+        "borders": overrides,
+        "hAlign": cell_h_align,
+    }
+    cell["_info"] = info
+    return info
+
+def _get_column_width(tcPr) -> Union[float, str]:
+    """欄寬: dxa -> pt, pct -> 百分比字串 (5000 = 100%)"""
+    if tcPr is None:
+        return 0
+    tcW = tcPr.find(W_TCW)
+    if tcW is None:
+        return 0
+    w_type = tcW.get(W_TYPE)
+    if w_type == 'dxa':
+        return int(tcW.get(W_W)) / 20.0
+    if w_type == 'pct':
+        try:
+            return f"{int(tcW.get(W_W))/50.0}%"
+        except (TypeError, ValueError):
+            pass
+    return 0
+
+def detect_fillable_tables(doc: Document, images: List[Dict] = [], table_offset: int = 0) -> List[Dict[str, Any]]:
+    """
+    table_offset: 平行解析時,此區塊第一個表格在整份文件中的索引
+    """
     tables_list = []
     
-    for table_idx, table in enumerate(doc.tables):
-        # Allow single row tables too if needed
-        if len(table.rows) < 1: 
-            continue
-        
-        table_style = {
-            "style_name": table.style.name if table.style else "Normal Table",
-            "alignment": table.alignment,
-            "autofit": table.autofit,
-            "row_heights": [row.height.pt if row.height else None for row in table.rows],
-            "col_widths": [] # Could be filled if needed
-        }
-            
-        header_row = table.rows[0]
-        columns = []
-        
-        # Extract Columns (Headers)
-        for cell in header_row.cells:
-            col_name = cell.text.strip()
-            # Simple heuristic for type
-            field_type = "text"
-            if re.search(r'(數量|金額|價格|單價)', col_name):
-                field_type = "number"
-            elif re.search(r'(日期|時間)', col_name):
-                field_type = "date"
-            
-            columns.append({
-                "name": re.sub(r'[^a-zA-Z0-9_]', '_', col_name.lower()) if col_name else f"col_{len(columns)}",
-                "label": col_name or "Column",
-                "type": field_type,
-                "type": field_type,
-                "width": cell.width.pt if cell.width else 0
-            })
-            
-            # Enhanced width extraction for pct
-            width_val = 0
-            if cell.width:
-                width_val = cell.width.pt
-            else:
-                try:
-                    tc = cell._tc
-                    tcPr = tc.tcPr
-                    if tcPr is not None:
-                        tcW = tcPr.find(qn('w:tcW'))
-                        if tcW is not None and tcW.get(qn('w:type')) == 'pct':
-                             # 5000 = 100%
-                             width_val = f"{int(tcW.get(qn('w:w')))/50.0}%"
-                except:
-                    pass
-            
-            columns[-1]['width'] = width_val
-        
-        # Extract Row Data (Content)
-        # We start from row 1 if we consider row 0 as header. 
-        # But for structure preservation, maybe we want row 0 as well?
-        # Usually 'columns' defines the schema, 'rows' defines the default data.
-        # If the table is purely for layout, header might just be the first row of data.
-        # Let's assume row 0 is header for schema, and we store ALL content including header in 'rows' if we want full fidelity?
-        # Or typical: columns = header, rows = slice(1).
+    for table_idx, table in enumerate(doc.tables, start=table_offset):
+        table_data = extract_table(table, table_idx, images)
+        if table_data is not None:
+            tables_list.append(table_data)
+    
+    return tables_list
+
+def extract_table(table, table_idx: int, images: List[Dict] = []) -> Optional[Dict[str, Any]]:
+    """解析單一表格 (欄位、儲存格內容與格式),空表格回傳 None"""
+    tbl = table._tbl
+    grid = build_table_grid(tbl)
+
+    # Allow single row tables too if needed
+    if len(grid) < 1:
+        return None
+    
+    # Extract Columns (Headers)
+    columns = []
+    for cell in grid[0]:
+        col_name = _extract_grid_cell(cell, table, images)["text"]
+        # Simple heuristic for type
+        field_type = "text"
+        if re.search(r'(數量|金額|價格|單價)', col_name):
+            field_type = "number"
+        elif re.search(r'(日期|時間)', col_name):
+            field_type = "date"
         
+        columns.append({
+            "name": re.sub(r'[^a-zA-Z0-9_]', '_', col_name.lower()) if col_name else f"col_{len(columns)}",
+            "label": col_name or "Column",
+            "type": field_type,
+            "width": _get_column_width(cell["tcPr"])
+        })
+    
+    # Extract Row Data (Content)
+    rows_data = []
+    cells_data = [] # New list for detailed cell info
+    row_formats = [] # New list for row formatting
+    
+    # 1. Parse Table-Level Borders (Defaults)
+    table_borders_def = {}
+    tblPr = tbl.tblPr
+    if tblPr is not None:
+        tblBorders = tblPr.find(W_TBL_BORDERS)
+        # Scan for all relevant sides including inside borders
+        table_borders_def = extract_borders_generic(tblBorders, keys=['top', 'bottom', 'left', 'right', 'insideH', 'insideV'])
         
-        # Extract Row Data (Content)
-        rows_data = []
-        cells_data = [] # New list for detailed cell info
-        row_formats = [] # New list for row formatting
+    total_rows_count = len(grid)
+
+    for r_idx, (tr, slots) in enumerate(zip(tbl.tr_lst, grid)):
+        # Extract Row Height
+        row_height = tr.trHeight_val
+        row_formats.append({
+            # EXACT, AUTO, AT_LEAST
+            "height": {"value": row_height.pt, "rule": str(tr.trHeight_hRule)} if row_height else None,
+            "isHeader": False # python-docx doesn't strictly track header rows easily
+        })
         
-        # 1. Parse Table-Level Borders (Defaults)
-        table_borders_def = {}
-        tblPr = table._tbl.tblPr
-        if tblPr is not None:
-            tblBorders = tblPr.find(qn('w:tblBorders'))
-            # Scan for all relevant sides including inside borders
-            table_borders_def = extract_borders_generic(tblBorders, keys=['top', 'bottom', 'left', 'right', 'insideH', 'insideV'])
+        row_dict = {}
+        num_cols = len(slots)
+        prev_slots = grid[r_idx - 1] if r_idx > 0 else None
+
+        for c_idx, cell in enumerate(slots):
+            info = _extract_grid_cell(cell, table, images)
+
+            # Map content to column name/id for rows_data
+            if c_idx < len(columns):
+                row_dict[columns[c_idx]['name']] = info["text"]
             
-        total_rows_count = len(table.rows)
-
-        for r_idx, row in enumerate(table.rows):
-            # Extract Row Height
-            row_height = None
-            row_height_rule = None
-            if row.height:
-                row_height = row.height.pt
-                row_height_rule = row.height_rule # EXACT, AUTO, AT_LEAST
+            # VMerge
+            vMergeVal = cell["vMerge"]
             
-            row_formats.append({
-                "height": {"value": row_height, "rule": str(row_height_rule)} if row_height else None,
-                "isHeader": getattr(row, 'is_header', False) # python-docx doesn't strictly track header rows easily
-            })
+            # Heuristic: If vMerge is 'restart' but text matches the cell directly above, treat as 'continue'
+            # This fixes tables where Word/Generator marks every cell as 'restart' despite identical content
+            # (continuation slots resolve to the same root cell, so they always match)
+            if vMergeVal == 'restart' and prev_slots is not None and c_idx < len(prev_slots):
+                prev_cell = prev_slots[c_idx]
+                if prev_cell is cell or _extract_grid_cell(prev_cell, table, images)["text"] == info["text"]:
+                    vMergeVal = "continue"
             
-            row_dict = {}
-            for c_idx, cell in enumerate(row.cells):
-                # ... existing logic ...
-                # Map content to column name/id for rows_data
-                if c_idx < len(columns):
-                    col_key = columns[c_idx]['name']
-                    row_dict[col_key] = cell.text.strip()
-                
-                # Extract detailed cell info for cells_data
-                tc = cell._tc
-                tcPr = tc.get_or_add_tcPr()
-                
-                # ColSpan (gridSpan)
-                gridSpan = tcPr.find(qn('w:gridSpan'))
-                colSpan = int(gridSpan.get(qn('w:val'))) if gridSpan is not None else 1
-                
-                # VMerge
-                vMerge = tcPr.find(qn('w:vMerge'))
-                vMergeVal = (vMerge.get(qn('w:val')) or "continue") if vMerge is not None else None
-                
-                # Heuristic: If vMerge is 'restart' but text matches the cell directly above, treat as 'continue'
-                # This fixes tables where Word/Generator marks every cell as 'restart' despite identical content
-                if vMergeVal == 'restart' and r_idx > 0:
-                    current_txt = cell.text.strip()
-                    try:
-                        prev_cell = table.rows[r_idx-1].cells[c_idx]
-                        prev_txt = prev_cell.text.strip()
-                        if current_txt == prev_txt:
-                            vMergeVal = "continue"
-                    except:
-                        pass
-                
-                cell_format = {
-                    "colSpan": colSpan,
-                    "vMerge": vMergeVal, # start, continue, or None
-                }
-
-                # Cell shading/background
-                shd = tcPr.find(qn('w:shd'))
-                if shd is not None:
-                    fill = shd.get(qn('w:fill'))
-                    if fill and fill != "auto":
-                        cell_format["backgroundColor"] = fill
-
-                # Vertical Alignment
-                vAlign = tcPr.find(qn('w:vAlign'))
-                if vAlign is not None:
-                    val = vAlign.get(qn('w:val'))
-                    # Map DOCX 'center' to CSS 'middle'
-                    if val == 'center':
-                        cell_format["vAlign"] = "middle"
-                    else:
-                        cell_format["vAlign"] = val
-                
-                # Text Direction (Vertical Text)
-                textDirection = tcPr.find(qn('w:textDirection'))
-                if textDirection is not None:
-                     # e.g. tbRl (top to bottom, right to left) -> vertical-rl
-                     # btLr (bottom to top, left to right) -> vertical-lr
-                     td_val = textDirection.get(qn('w:val'))
-                     if td_val in ['tbRl', 'btLr']:
-                         cell_format["textDirection"] = "vertical-rl" # Simplified mapping
-                         cell_format["textDirection"] = "vertical-rl" # Simplified mapping
-                         cell_format["writingMode"] = "vertical-rl"
-
-                         cell_format["writingMode"] = "vertical-rl"
-
-                # Cell Borders - High Fidelity Logic
-                # 1. Start with Default Table Borders based on position
-                cell_border_style = {}
-                num_cols = len(row.cells)
-                
-                # Top
-                if r_idx == 0:
-                    if 'borderTop' in table_borders_def: cell_border_style['borderTop'] = table_borders_def['borderTop']
-                else:
-                    if 'borderInsideH' in table_borders_def: cell_border_style['borderTop'] = table_borders_def['borderInsideH']
-                
-                # Bottom
-                if r_idx == total_rows_count - 1:
-                     if 'borderBottom' in table_borders_def: cell_border_style['borderBottom'] = table_borders_def['borderBottom']
-                else:
-                     if 'borderInsideH' in table_borders_def: cell_border_style['borderBottom'] = table_borders_def['borderInsideH']
-                     
-                # Left
-                if c_idx == 0:
-                     if 'borderLeft' in table_borders_def: cell_border_style['borderLeft'] = table_borders_def['borderLeft']
-                else:
-                     if 'borderInsideV' in table_borders_def: cell_border_style['borderLeft'] = table_borders_def['borderInsideV']
+            cell_format = {
+                "colSpan": cell["colSpan"],
+                "vMerge": vMergeVal, # start, continue, or None
+            }
+            cell_format.update(info["format"])
 
-                # Right
-                if c_idx == num_cols - 1:
-                     if 'borderRight' in table_borders_def: cell_border_style['borderRight'] = table_borders_def['borderRight']
-                else:
-                     if 'borderInsideV' in table_borders_def: cell_border_style['borderRight'] = table_borders_def['borderInsideV']
-                     
-                # 2. Extract Specific Cell Overrides (tcBorders)
-                cell_overrides = extract_cell_borders(tcPr)
-                cell_border_style.update(cell_overrides)
-
-                if cell_border_style:
-                    cell_format["borders"] = cell_border_style
-
-                # Runs extraction for the cell
-                cell_runs = []
-                cell_h_align = None
-
-                for p_idx, p in enumerate(cell.paragraphs):
-                    # 1. Determine Horizontal Alignment (First paragraph wins usually)
-                    if cell_h_align is None:
-                        # Try helper or direct access
-                        align_val = p.alignment
-                        if align_val == WD_ALIGN_PARAGRAPH.CENTER:
-                            cell_h_align = 'center'
-                        elif align_val == WD_ALIGN_PARAGRAPH.RIGHT:
-                            cell_h_align = 'right'
-                        elif align_val == WD_ALIGN_PARAGRAPH.JUSTIFY:
-                            cell_h_align = 'both' # Frontend uses 'both' for justify
-                        # Check w:jc fallback
-                        try:
-                            if not cell_h_align and p._element.pPr:
-                                jc = p._element.pPr.find(qn('w:jc'))
-                                if jc is not None:
-                                    val = jc.get(qn('w:val'))
-                                    if val == 'center': cell_h_align = 'center'
-                                    elif val == 'right': cell_h_align = 'right'
-                                    elif val == 'both': cell_h_align = 'both'
-                        except: pass
-                    
-                    # 2. Handle Line Breaks (Between paragraphs)
-                    if p_idx > 0:
-                        cell_runs.append({
-                            "text": "\n",
-                            "type": "text",
-                            "format": {}
-                        })
+            # Cell Borders - High Fidelity Logic
+            # 1. Start with Default Table Borders based on position
+            cell_border_style = {}
+            
+            # Top
+            if r_idx == 0:
+                if 'borderTop' in table_borders_def: cell_border_style['borderTop'] = table_borders_def['borderTop']
+            else:
+                if 'borderInsideH' in table_borders_def: cell_border_style['borderTop'] = table_borders_def['borderInsideH']
+            
+            # Bottom
+            if r_idx == total_rows_count - 1:
+                 if 'borderBottom' in table_borders_def: cell_border_style['borderBottom'] = table_borders_def['borderBottom']
+            else:
+                 if 'borderInsideH' in table_borders_def: cell_border_style['borderBottom'] = table_borders_def['borderInsideH']
+                 
+            # Left
+            if c_idx == 0:
+                 if 'borderLeft' in table_borders_def: cell_border_style['borderLeft'] = table_borders_def['borderLeft']
+            else:
+                 if 'borderInsideV' in table_borders_def: cell_border_style['borderLeft'] = table_borders_def['borderInsideV']
 
-                    # 3. Runs Extraction (Supports Inline Images)
-                    p_runs = extract_runs(p, images)
-                    
-                    # 4. Check for Numbering (Bullets)
-                    try:
-                        if p._element.pPr is not None and p._element.pPr.find(qn('w:numPr')) is not None:
-                             bullet_run = {
-                                 "text": "• ", 
-                                 "format": p_runs[0]['format'] if p_runs else {} 
-                             }
-                             p_runs.insert(0, bullet_run)
-                    except:
-                        pass
-                        
-                    cell_runs.extend(p_runs)
+            # Right
+            if c_idx == num_cols - 1:
+                 if 'borderRight' in table_borders_def: cell_border_style['borderRight'] = table_borders_def['borderRight']
+            else:
+                 if 'borderInsideV' in table_borders_def: cell_border_style['borderRight'] = table_borders_def['borderInsideV']
+                 
+            # 2. Apply Specific Cell Overrides (tcBorders)
+            cell_border_style.update(info["borders"])
 
-                if cell_h_align:
-                    cell_format["hAlign"] = cell_h_align
+            if cell_border_style:
+                cell_format["borders"] = cell_border_style
 
-                cells_data.append({
-                    "row": r_idx,
-                    "col": c_idx,
-                    "text": cell.text.strip(),
-                    "runs": cell_runs,
-                    "format": cell_format
-                })
-            
-            rows_data.append(row_dict)
+            if info["hAlign"]:
+                cell_format["hAlign"] = info["hAlign"]
 
-        # Extract Table Level Properties
-        tblPr = table._tbl.tblPr
-        table_width = None
-        table_indent = None
-        
-        if tblPr is not None:
-             tblW = tblPr.find(qn('w:tblW'))
-             if tblW is not None:
-                 w_type = tblW.get(qn('w:type'))
-                 w_val = int(tblW.get(qn('w:w'), 0))
-                 if w_type == 'dxa':
-                     table_width = w_val / 20.0
-                 elif w_type == 'pct':
-                     table_width = f"{w_val / 50.0}%"
-                     pass
-                     
-             tblInd = tblPr.find(qn('w:tblInd'))
-             if tblInd is not None:
-                 ind_type = tblInd.get(qn('w:type'))
-                 ind_val = int(tblInd.get(qn('w:w'), 0))
-                 if ind_type == 'dxa':
-                     table_indent = ind_val / 20.0
-        
-        table_style = {
-            "width": table_width,
-            "marginLeft": table_indent
-        }
+            cells_data.append({
+                "row": r_idx,
+                "col": c_idx,
+                "text": info["text"],
+                "runs": info["runs"],
+                "format": cell_format
+            })
         
-        tables_list.append({
-            "name": f"table_{table_idx + 1}",
-            "label": f"表格 {table_idx + 1}",
-            "columns": columns,
-            "columnWidths": [c['width'] for c in columns], # Extract simple array for frontend
-            "rows": rows_data,
-            "cells": cells_data,
-            "rowFormats": row_formats, # Add row formats
-            "min_rows": 1,
-            "max_rows": 100,
-            "position": {"table_index": table_idx},
-            "style": table_style
-        })
+        rows_data.append(row_dict)
+
+    # Extract Table Level Properties
+    table_width = None
+    table_indent = None
     
-    return tables_list
+    if tblPr is not None:
+         tblW = tblPr.find(W_TBL_W)
+         if tblW is not None:
+             w_type = tblW.get(W_TYPE)
+             w_val = int(tblW.get(W_W, 0))
+             if w_type == 'dxa':
+                 table_width = w_val / 20.0
+             elif w_type == 'pct':
+                 table_width = f"{w_val / 50.0}%"
+                 
+         tblInd = tblPr.find(W_TBL_IND)
+         if tblInd is not None:
+             ind_type = tblInd.get(W_TYPE)
+             ind_val = int(tblInd.get(W_W, 0))
+             if ind_type == 'dxa':
+                 table_indent = ind_val / 20.0
+    
+    table_style = {
+        "width": table_width,
+        "marginLeft": table_indent
+    }
+    
+    return {
+        "name": f"table_{table_idx + 1}",
+        "label": f"表格 {table_idx + 1}",
+        "columns": columns,
+        "columnWidths": [c['width'] for c in columns], # Extract simple array for frontend
+        "rows": rows_data,
+        "cells": cells_data,
+        "rowFormats": row_formats, # Add row formats
+        "min_rows": 1,
+        "max_rows": 100,
+        "position": {"table_index": table_idx},
+        "style": table_style
+    }
 
 def extract_run_style(run) -> Dict[str, Any]:
     style = {}
@@ -834,13 +1032,8 @@ def extract_run_elements(run, images=[]) -> List[Dict]:
             if sym_text:
                  elements.append({"type": "text", "content": sym_text})
         
-        elif tag == qn('w:drawing') or child.get('temp_img_id'):
-             img_id = child.get('temp_img_id')
-             if not img_id:
-                 for d in child.iterdescendants():
-                     if d.get('temp_img_id'):
-                         img_id = d.get('temp_img_id')
-                         break
+        elif tag == W_DRAWING or child.get('temp_img_id'):
+             img_id = find_temp_img_id(child)
              
              if img_id and images:
                   found = next((img for img in images if img['id'] == img_id), None)
@@ -886,38 +1079,75 @@ def extract_runs(para, images=[]) -> List[Dict[str, Any]]:
             
     return runs
 
-def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dict], images: List[Dict]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dict], images: List[Dict],
+                             para_offset: int = 0, table_offset: int = 0) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
     """
     建立文件的線性結構 (包含 Field, Table, Image, AND Plain Paragraphs)
     修復: 確保所有內容都被包含
+    para_offset / table_offset: 平行解析時,此區塊在整份文件中的起始段落/表格索引
+    分頁切割出的表格會附加到 tables
     Returns:
         structure:List, paragraphs:List
     """
     structure = []
     paragraphs = []
-    para_idx = 0
-    table_idx = 0
+    tables_by_index = {}
+    for t in tables:
+        tables_by_index.setdefault(t['position']['table_index'], t)
+
+    for block_structure, block_paragraphs, table_parts in iter_document_structure(
+            doc, fields, images, lambda table_idx, tbl: tables_by_index.get(table_idx), para_offset, table_offset):
+        structure.extend(block_structure)
+        paragraphs.extend(block_paragraphs)
+        tables.extend(table_parts)
+
+    return structure, paragraphs
+
+def iter_document_structure(doc: Document, fields: List[Dict], images: List[Dict],
+                            resolve_table: Callable[[int, CT_Tbl], Optional[Dict]],
+                            para_offset: int = 0, table_offset: int = 0) -> Iterator[Tuple[List[Dict], List[Dict], List[Dict]]]:
+    """
+    逐個頂層區塊 (段落/表格) 產生結構,供一般解析與串流輸出共用
+    resolve_table(table_index, tbl_element): 取得該表格的解析結果 (可延遲解析)
+    Yields:
+        structure:List, paragraphs:List, table_parts:List (分頁切割出的表格)
+    """
+    para_idx = para_offset
+    table_idx = table_offset
+    doc_paragraphs = doc.paragraphs # doc.paragraphs 每次存取都會重建清單,只取一次
+
+    # 預先建立索引,避免每個段落都掃描全部欄位與圖片
+    fields_by_para = {}
+    for f in fields:
+        fields_by_para.setdefault(f['position']['paragraph_index'], []).append(f)
+    images_by_temp_id = {}
+    images_by_para = {}
+    for img in images:
+        images_by_temp_id.setdefault(img.get('para_temp_id'), []).append(img)
+        images_by_para.setdefault(img['paragraph_index'], []).append(img)
     
     # 遍歷 body 的所有子元素
     for child in doc.element.body.iterchildren():
+        structure = []
+        paragraphs = []
+        table_parts = []
+
         if isinstance(child, CT_P):
             # 這是一個段落
             para_id = str(uuid.uuid4())
-            
-            # Check for fields (Partial match inside paragraph?)
-            related_fields = [f for f in fields if f['position']['paragraph_index'] == para_idx]
+            current_para = doc_paragraphs[para_idx - para_offset]
             
             # Match images by temp_id
             c_temp_id = child.get('temp_id')
             related_images = []
             if c_temp_id:
-                related_images = [img for img in images if img.get('para_temp_id') == c_temp_id]
+                related_images = images_by_temp_id.get(c_temp_id, [])
             else:
                  # Fallback to paragraph_index if temp_id missing
-                 related_images = [img for img in images if img['paragraph_index'] == para_idx]
+                 related_images = images_by_para.get(para_idx, [])
 
             # If it's a field paragraph, just output the field
-            related_fields = [f for f in fields if f['position']['paragraph_index'] == para_idx]
+            related_fields = fields_by_para.get(para_idx, [])
             if related_fields:
                 for field in related_fields:
                     structure.append({
@@ -928,6 +1158,7 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                         "block_index": para_idx
                     })
                 para_idx += 1
+                yield structure, paragraphs, table_parts
                 continue
 
             # Advanced: Interleave Text and Images based on run order
@@ -949,8 +1180,8 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                 paragraphs.append({
                     "id": current_uuid,
                     "text": text_content,
-                    "style": doc.paragraphs[para_idx].style.name if doc.paragraphs[para_idx].style else "Normal",
-                    "format": extract_paragraph_style(doc.paragraphs[para_idx]),
+                    "style": current_para.style.name if current_para.style else "Normal",
+                    "format": extract_paragraph_style(current_para),
                     "runs": runs_list,
                     "index": para_idx
                 })
@@ -1006,35 +1237,27 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
             try:
                 # Iterate direct children of the paragraph (usually w:r or drawings)
                 for i, elem in enumerate(child.iterchildren()):
-                    # Debug log
-                    tag_name = get_local_tag(elem.tag)
-                    
                     # Handle Fields
                     if elem.tag == qn('w:fldSimple'):
-                        runs = extract_runs_from_element(elem, doc.paragraphs[para_idx])
+                        runs = extract_runs_from_element(elem, current_para)
                         if runs:
                             current_text_runs.extend(runs)
                             has_content = True
                         continue
 
                     # Handle Runs (w:r)
-                    if elem.tag == qn('w:r'):
+                    if elem.tag == W_R:
                         # Iterate inside the run for perfect interleaving of text, drawings, and breaks
                         for j, run_child in enumerate(elem.iterchildren()):
-                            tag_local = get_local_tag(run_child.tag)
+                            tag = run_child.tag
                             
                             # 1. Check for Image in this run element
-                            xml_img_id = run_child.get('temp_img_id')
-                            if not xml_img_id:
-                                for d in run_child.iterdescendants():
-                                    if d.get('temp_img_id'):
-                                        xml_img_id = d.get('temp_img_id')
-                                        break
+                            xml_img_id = find_temp_img_id(run_child)
                             
                             if xml_img_id:
                                 found_img = find_image_by_xml_id(xml_img_id)
                                 if found_img:
-                                    # print(f"[DEBUG] Found Image {xml_img_id} in Para {para_idx} Run {i} Child {j} ({tag_local})")
+                                    # print(f"[DEBUG] Found Image {xml_img_id} in Para {para_idx} Run {i} Child {j}")
                                     commit_text_block(current_text_runs)
                                     current_text_runs = []
                                     structure.append({
@@ -1053,9 +1276,9 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                                     # print(f"[DEBUG] Image ID found {xml_img_id} but lookup failed in Para {para_idx}")
 
                             # 2. Check for Text (w:t)
-                            if tag_local == 't':
+                            if tag == W_T:
                                 # Use python-docx Run to handle styling correctly
-                                run_obj = Run(elem, doc.paragraphs[para_idx])
+                                run_obj = Run(elem, current_para)
                                 style_val = {}
                                 if run_obj.bold: style_val['bold'] = True
                                 if run_obj.italic: style_val['italic'] = True
@@ -1084,7 +1307,7 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                                     has_content = True
                             
                             # 3. Check for Page Breaks
-                            elif tag_local == 'lastRenderedPageBreak' or (tag_local == 'br' and run_child.get(qn('w:type')) == 'page'):
+                            elif tag == W_LAST_RENDERED_PAGE_BREAK or (tag == W_BR and run_child.get(W_TYPE) == 'page'):
                                 commit_text_block(current_text_runs)
                                 current_text_runs = []
                                 structure.append({
@@ -1093,19 +1316,14 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                                 })
                             
                             # 4. Check for carriage returns / breaks
-                            elif tag_local == 'br':
+                            elif tag == W_BR:
                                 current_text_runs.append({"text": "\n", "format": {}})
-                            elif tag_local == 'tab':
+                            elif tag == W_TAB:
                                 current_text_runs.append({"text": "\t", "format": {}})
 
                     # Handle direct Drawings
-                    elif elem.tag == qn('w:drawing') or elem.get('temp_img_id'):
-                        xml_img_id = elem.get('temp_img_id')
-                        if not xml_img_id:
-                            for d in elem.iterdescendants():
-                                if d.get('temp_img_id'):
-                                    xml_img_id = d.get('temp_img_id')
-                                    break
+                    elif elem.tag == W_DRAWING or elem.get('temp_img_id'):
+                        xml_img_id = find_temp_img_id(elem)
                         
                         if xml_img_id:
                             found_img = find_image_by_xml_id(xml_img_id)
@@ -1129,7 +1347,7 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                 print(f"Error parsing paragraph interleaved content: {e}")
                 # Strong fallback
                 if not has_content:
-                    runs = extract_runs(doc.paragraphs[para_idx])
+                    runs = extract_runs(current_para)
                     commit_text_block(runs)
                     has_content = True
 
@@ -1141,8 +1359,8 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                 paragraphs.append({
                     "id": current_uuid,
                     "text": "",
-                    "style": doc.paragraphs[para_idx].style.name if doc.paragraphs[para_idx].style else "Normal",
-                    "format": extract_paragraph_style(doc.paragraphs[para_idx]),
+                    "style": current_para.style.name if current_para.style else "Normal",
+                    "format": extract_paragraph_style(current_para),
                     "runs": [],
                     "index": para_idx
                 })
@@ -1159,7 +1377,7 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
             # 這是一個表格
             # Find matching table object
             # Our tables list is built from doc.tables, which iterates in order.
-            related_table = next((t for t in tables if t['position']['table_index'] == table_idx), None)
+            related_table = resolve_table(table_idx, child)
             
             if related_table:
                 # 檢查表格內的分頁符 (lastRenderedPageBreak 或 w:br type="page")
@@ -1167,29 +1385,13 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                 row_break_indices = []
                 # Use raw XML iteration for speed and access to breaks
                 for r_idx, row in enumerate(child.iterchildren()):
-                    if row.tag.endswith('tr'):
+                    if row.tag == W_TR:
                         # Check XML of the row for page break
                         # Note: This finds break ANYWHERE in the row (cells).
                         # We assume break means "End of Page is reached during or after this row"
                         # So we split separate chunks.
-                        # However, iterating ALL content might be slow for huge tables?
-                        # But necessary.
-                        found_break = False
-                        # Optimization: check text runs inside cells? 
-                        # Simple XML check:
-                        # row_xml = getattr(row, 'xml', None) 
-                        
-                        # Use iterdescendants to find tags
-                        found_break = False
-                        for d in row.iterdescendants():
-                            if d.tag == qn('w:lastRenderedPageBreak'):
-                                found_break = True
-                                break
-                            if d.tag == qn('w:br') and d.get(qn('w:type')) == 'page':
-                                found_break = True
-                                break
-                        
-                        if found_break:
+                        # Compiled XPath keeps the descendant scan in C
+                        if XPATH_HAS_PAGE_BREAK(row):
                             row_break_indices.append(r_idx)
                 
                 if not row_break_indices:
@@ -1250,7 +1452,7 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                         new_table['part_index'] = i
                         
                         # Register new table
-                        tables.append(new_table)
+                        table_parts.append(new_table)
                         
                         # Add to structure
                         structure.append({
@@ -1274,94 +1476,1141 @@ def build_document_structure(doc: Document, fields: List[Dict], tables: List[Dic
                  pass
                  
             table_idx += 1
-            
-    return structure, paragraphs
+
+        else:
+            continue
+
+        yield structure, paragraphs, table_parts
+
+# ==================== 精簡編碼 (compact) ====================
+
+# 表格的精簡輸出格式版本 (前端依此判斷是否需要解碼)
+COMPACT_TABLE_ENCODING = "compact-v1"
+BORDER_SIDES = ('borderTop', 'borderRight', 'borderBottom', 'borderLeft')
+
+class _FormatTable:
+    """將重複的格式 dict 去重,回傳整數索引"""
+    def __init__(self):
+        self.items = []
+        self._index = {}
+
+    def ref(self, value) -> int:
+        key = json.dumps(value, sort_keys=True, ensure_ascii=False)
+        idx = self._index.get(key)
+        if idx is None:
+            idx = len(self.items)
+            self._index[key] = idx
+            self.items.append(value)
+        return idx
+
+def compact_table(table: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    將 detect_fillable_tables 的表格轉為精簡格式:
+    - borderStyles: 不重複的 CSS border 字串
+    - cellFormats: 不重複的儲存格格式,borders 改為 [top, right, bottom, left] 的 borderStyles 索引 (無則 null)
+    - runFormats: 不重複的 run 格式
+    - cells: [row, col, text, cellFormat 索引, runs]
+      runs: 文字為 [text, runFormat 索引];圖片為 {"type": "image", "image_id": id, "f": runFormat 索引}
+    - rows: 依 rowKeys 順序的值陣列 (缺少的欄位為 null)
+    其餘欄位 (columns, rowFormats, style...) 不變
+    """
+    border_styles = _FormatTable()
+    cell_formats = _FormatTable()
+    run_formats = _FormatTable()
+
+    cells = []
+    for cell in table.get('cells', []):
+        fmt = dict(cell['format'])
+        borders = fmt.pop('borders', None)
+        if borders:
+            fmt['borders'] = [border_styles.ref(borders[side]) if side in borders else None for side in BORDER_SIDES]
+
+        runs = []
+        for run in cell['runs']:
+            f = run_formats.ref(run.get('format', {}))
+            if run.get('type') == 'image':
+                runs.append({"type": "image", "image_id": run['image_data'].get('id'), "f": f})
+            else:
+                runs.append([run.get('text', ''), f])
+
+        cells.append([cell['row'], cell['col'], cell['text'], cell_formats.ref(fmt), runs])
+
+    row_keys = []
+    for row in table.get('rows', []):
+        for key in row:
+            if key not in row_keys:
+                row_keys.append(key)
+
+    compact = {k: v for k, v in table.items() if k not in ('cells', 'rows')}
+    compact.update({
+        "encoding": COMPACT_TABLE_ENCODING,
+        "borderStyles": border_styles.items,
+        "cellFormats": cell_formats.items,
+        "runFormats": run_formats.items,
+        "rowKeys": row_keys,
+        "rows": [[row.get(key) for key in row_keys] for row in table.get('rows', [])],
+        "cells": cells
+    })
+    return compact
+
+def expand_compact_table(table: Dict[str, Any], images: List[Dict] = []) -> Dict[str, Any]:
+    """compact_table 的反向轉換 (參考實作,前端解碼邏輯需與此一致)"""
+    if table.get('encoding') != COMPACT_TABLE_ENCODING:
+        return table
+
+    border_styles = table['borderStyles']
+    cell_formats = table['cellFormats']
+    run_formats = table['runFormats']
+    images_by_id = {img['id']: img for img in images}
+
+    cells = []
+    for row, col, text, fmt_idx, compact_runs in table['cells']:
+        fmt = dict(cell_formats[fmt_idx])
+        if 'borders' in fmt:
+            fmt['borders'] = {
+                side: border_styles[ref] for side, ref in zip(BORDER_SIDES, fmt['borders']) if ref is not None
+            }
+
+        runs = []
+        for run in compact_runs:
+            if isinstance(run, dict):
+                runs.append({
+                    "type": "image",
+                    "image_data": images_by_id.get(run['image_id'], {"id": run['image_id']}),
+                    "format": run_formats[run['f']]
+                })
+            else:
+                runs.append({"text": run[0], "format": run_formats[run[1]]})
+
+        cells.append({"row": row, "col": col, "text": text, "runs": runs, "format": fmt})
+
+    row_keys = table['rowKeys']
+    expanded = {k: v for k, v in table.items() if k not in ('encoding', 'borderStyles', 'cellFormats', 'runFormats', 'rowKeys')}
+    expanded['rows'] = [
+        {key: value for key, value in zip(row_keys, values) if value is not None} for values in table['rows']
+    ]
+    expanded['cells'] = cells
+    return expanded
+
+# ==================== 平行解析 ====================
+
+# 平行解析的 worker 數量與每個區塊最少的 body 區塊數 (太小的區塊重新載入文件的成本會高於解析本身)
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", os.cpu_count() or 1))
+MIN_BLOCKS_PER_CHUNK = int(os.environ.get("PARSE_MIN_BLOCKS_PER_CHUNK", 200))
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # uvicorn 行程內有多個執行緒 (thread pool、httpx 等),fork 可能複製到被鎖住的 lock 而卡死;
+            # 改由 forkserver 產生乾淨的 worker 行程
+            _process_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                                mp_context=multiprocessing.get_context("forkserver"))
+        return _process_pool
+
+def _discard_process_pool(pool: ProcessPoolExecutor):
+    """
+    worker 異常結束 (例如大型範本被 OOM killer 砍掉) 後 pool 會永久 broken,
+    丟棄它讓下一次 _get_process_pool 建立新的;只有當時使用中的請求會失敗
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _iter_body_blocks(doc: Document):
+    """body 中的頂層區塊 (段落與表格),依文件順序"""
+    return [child for child in doc.element.body.iterchildren() if isinstance(child, (CT_P, CT_Tbl))]
+
+def _parse_block_chunk(docx_bytes: bytes, start: int, end: int, para_offset: int, table_offset: int,
+                       fields: List[Dict], images: List[Dict]) -> Tuple[List[Dict], List[Dict], List[Dict], List[Dict]]:
+    """
+    Worker: 重新載入已標記圖片的文件,只保留 [start, end) 的頂層區塊後解析
+    Returns:
+        tables, table_parts (分頁切割出的表格), structure, paragraphs
+    """
+    doc = Document(io.BytesIO(docx_bytes))
+    body = doc.element.body
+    for i, child in enumerate(_iter_body_blocks(doc)):
+        if i < start or i >= end:
+            body.remove(child)
+
+    tables = detect_fillable_tables(doc, images, table_offset=table_offset)
+    table_count = len(tables)
+    structure, paragraphs = build_document_structure(doc, fields, tables, images, para_offset, table_offset)
+    return tables[:table_count], tables[table_count:], structure, paragraphs
+
+def parse_blocks_parallel(doc: Document, fields: List[Dict], images: List[Dict],
+                          workers: Optional[int] = None) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+    """
+    將文件切成頂層區塊的 chunk,在 process pool 中平行解析表格與結構,再依文件順序合併
+    必須在 extract_images_from_doc 之後呼叫 (worker 依賴 temp_id / temp_img_id 標記)
+    Returns:
+        tables, structure, paragraphs (與循序解析相同的格式與順序)
+    """
+    workers = workers or PARSE_WORKERS
+    blocks = _iter_body_blocks(doc)
+    chunk_count = min(workers, -(-len(blocks) // MIN_BLOCKS_PER_CHUNK))
+
+    if chunk_count <= 1:
+        tables = detect_fillable_tables(doc, images)
+        structure, paragraphs = build_document_structure(doc, fields, tables, images)
+        return tables, structure, paragraphs
+
+    # 序列化一次 (包含圖片標記),各 worker 自行重新載入
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    docx_bytes = buffer.getvalue()
+
+    chunk_size = -(-len(blocks) // chunk_count)
+    futures = []
+    para_offset = 0
+    table_offset = 0
+    pool = _get_process_pool()
+    try:
+        for start in range(0, len(blocks), chunk_size):
+            chunk = blocks[start:start + chunk_size]
+            para_count = sum(1 for b in chunk if isinstance(b, CT_P))
+            chunk_fields = [f for f in fields if para_offset <= f['position']['paragraph_index'] < para_offset + para_count]
+            futures.append(pool.submit(
+                _parse_block_chunk, docx_bytes, start, start + len(chunk),
+                para_offset, table_offset, chunk_fields, images
+            ))
+            para_offset += para_count
+            table_offset += len(chunk) - para_count
+        chunk_results = [future.result() for future in futures]
+    except BrokenProcessPool:
+        _discard_process_pool(pool)
+        raise
+
+    tables, table_parts, structure, paragraphs = [], [], [], []
+    for chunk_tables, chunk_parts, chunk_structure, chunk_paragraphs in chunk_results:
+        tables.extend(chunk_tables)
+        table_parts.extend(chunk_parts)
+        structure.extend(chunk_structure)
+        paragraphs.extend(chunk_paragraphs)
+
+    # 與循序解析一致: 分頁切割出的表格附加在所有表格之後
+    tables.extend(table_parts)
+    return tables, structure, paragraphs
+
+# ==================== 效能分析 ====================
+
+# cProfile dump 存放目錄
+PROFILE_DIR = Path(os.environ.get("TEMPLATE_PROFILE_DIR", "/tmp/template-profiles"))
+PROFILE_TOP_FUNCTIONS = 25
+# 目錄中最多保留的 .prof 檔數,超過時刪除最舊的
+PROFILE_MAX_DUMPS = int(os.environ.get("TEMPLATE_PROFILE_MAX_DUMPS", 50))
+
+_profile_dump_lock = threading.Lock()
+
+class ParseProfiler:
+    """
+    單次解析的效能分析: 各階段耗時、元素數量,以及 (選用) cProfile
+    """
+    def __init__(self, cprofile: bool = False):
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._profile = cProfile.Profile() if cprofile else None
+        self._start = None
+        self._end = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        if self._profile is not None:
+            self._profile.enable()
+
+    def stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+        self._end = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        """累計同名階段的耗時 (例如每張圖片的上傳)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count_elements(self, doc: Document):
+        body = doc.element.body
+        self.counts = {
+            "paragraphs": sum(1 for _ in body.iter(W_P)),
+            "runs": sum(1 for _ in body.iter(W_R)),
+            "tables": sum(1 for _ in body.iter(W_TBL)),
+            "cells": sum(1 for _ in body.iter(W_TC)),
+            "drawings": sum(1 for _ in body.iter(W_DRAWING, W_PICT)),
+        }
+
+    def report(self, template_id: str) -> Dict[str, Any]:
+        report = {
+            "total_seconds": round((self._end or time.perf_counter()) - (self._start or 0), 4),
+            "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            "counts": self.counts
+        }
+        if self._profile is not None:
+            report["cprofile"] = self._dump_cprofile(template_id)
+        return report
+
+    def _dump_cprofile(self, template_id: str) -> Dict[str, Any]:
+        dump_path = _profile_dump_path(template_id)
+        self._profile.dump_stats(str(dump_path))
+        _rotate_profile_dumps()
+
+        stats = pstats.Stats(self._profile).sort_stats("cumulative")
+        top = []
+        for func in stats.fcn_list[:PROFILE_TOP_FUNCTIONS]:
+            _, ncalls, tottime, cumtime, _ = stats.stats[func]
+            filename, line, name = func
+            top.append({
+                "function": f"{os.path.basename(filename)}:{line}({name})",
+                "calls": ncalls,
+                "tottime": round(tottime, 4),
+                "cumtime": round(cumtime, 4)
+            })
+        return {"path": str(dump_path), "top_functions": top}
+
+def _profile_dump_path(template_id: str) -> Path:
+    """
+    template_id 由用戶端提供: 只保留 [A-Za-z0-9_-] 並加上隨機後綴,
+    避免路徑穿越,同一秒內的多個請求也不會互相覆蓋
+    """
+    profile_dir = PROFILE_DIR.resolve()
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", template_id or "")[:64] or "template"
+    dump_path = (profile_dir / f"{safe_id}_{int(time.time())}_{uuid.uuid4().hex[:8]}.prof").resolve()
+    if dump_path.parent != profile_dir:
+        raise ValueError(f"Invalid profile dump path: {dump_path}")
+    return dump_path
+
+def _rotate_profile_dumps():
+    """只保留最新的 PROFILE_MAX_DUMPS 個 .prof 檔"""
+    with _profile_dump_lock:
+        dumps = sorted(PROFILE_DIR.glob("*.prof"), key=lambda p: p.stat().st_mtime)
+        for old in dumps[:max(len(dumps) - PROFILE_MAX_DUMPS, 0)]:
+            old.unlink(missing_ok=True)
+
+def _stage(profiler: Optional[ParseProfiler], name: str):
+    return profiler.stage(name) if profiler is not None else nullcontext()
+
+# ==================== 差異解析 (diff) ====================
+
+# 快取最近解析的範本 (依 template_id),供使用者修改後重新上傳時只重新解析變動的區塊
+PARSE_CACHE_SIZE = int(os.environ.get("PARSE_CACHE_SIZE", 32))
+
+_parse_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_parse_cache_lock = threading.Lock()
+_template_locks: Dict[str, threading.Lock] = {}
+
+def _template_lock(template_id: str) -> threading.Lock:
+    """同一範本的差異解析依序執行 (快取中的區塊結果會就地重新編號)"""
+    with _parse_cache_lock:
+        return _template_locks.setdefault(template_id, threading.Lock())
+
+# 區塊內引用的關聯 (圖片、超連結等): 內容雜湊需包含被引用的 part,替換圖片時才會視為變動
+XPATH_RELATIONSHIP_IDS = etree.XPath(
+    './/@r:embed | .//@r:link | .//@r:id',
+    namespaces={'r': nsmap['r']}
+)
+
+def _doc_level_hash(doc: Document) -> str:
+    """樣式與編號定義會影響每個區塊的輸出,變動時整份重新解析"""
+    digest = hashlib.sha1()
+    # 直接查關聯,不用 doc.part.numbering_part (缺少時會新增一個空的編號 part)
+    for reltype in (RT.STYLES, RT.NUMBERING):
+        try:
+            digest.update(doc.part.part_related_by(reltype).blob)
+        except KeyError:
+            pass
+    return digest.hexdigest()
+
+def _block_hash(doc: Document, block) -> str:
+    """頂層區塊的內容雜湊 (XML + 引用的 part),必須在 extract_images_from_doc 標記 temp_id 之前計算"""
+    digest = hashlib.sha1(etree.tostring(block))
+    rels = doc.part.rels
+    for rId in XPATH_RELATIONSHIP_IDS(block):
+        rel = rels.get(rId)
+        if rel is None:
+            continue
+        digest.update(rel.target_ref.encode("utf-8") if rel.is_external else rel.target_part.blob)
+    return digest.hexdigest()
+
+def _parse_block_records(doc: Document, template_id: str, lazy_images: bool = False) -> List[Dict[str, Any]]:
+    """
+    解析文件並依頂層區塊拆開結果,每個區塊一筆:
+    {"kind": "p" | "tbl", "structure", "paragraphs", "fields", "tables" (含分頁切割出的部分), "images"}
+    """
+    images = extract_images_from_doc(doc, template_id, lazy=lazy_images)
+    for img in images:
+        img.pop('_parent_elem', None)
+    fields = detect_fillable_fields(doc)
+
+    images_by_id = {img['id']: img for img in images}
+    fields_by_para = {}
+    for f in fields:
+        fields_by_para.setdefault(f['position']['paragraph_index'], []).append(f)
+
+    resolved = {}
+    def resolve_table(table_idx, tbl):
+        resolved[table_idx] = extract_table(Table(tbl, doc._body), table_idx, images)
+        return resolved[table_idx]
+
+    records = []
+    para_idx = 0
+    table_idx = 0
+    blocks = _iter_body_blocks(doc)
+    for block, (structure, paragraphs, table_parts) in zip(
+            blocks, iter_document_structure(doc, fields, images, resolve_table)):
+        block_images = [images_by_id[elem.get('temp_img_id')] for elem in block.iter(W_DRAWING, W_PICT)
+                        if elem.get('temp_img_id') in images_by_id]
+        record = {"structure": structure, "paragraphs": paragraphs, "images": block_images,
+                  "fields": [], "tables": []}
+        if isinstance(block, CT_P):
+            record["kind"] = "p"
+            record["fields"] = fields_by_para.get(para_idx, [])
+            para_idx += 1
+        else:
+            record["kind"] = "tbl"
+            main_table = resolved.get(table_idx)
+            record["tables"] = ([main_table] if main_table else []) + table_parts
+            table_idx += 1
+        records.append(record)
+    return records
+
+def _name_number(name: str) -> int:
+    match = re.search(r'_(\d+)$', name)
+    return int(match.group(1)) if match else 0
+
+def _rename_record(record: Dict[str, Any], next_field: int, next_table: int) -> Tuple[int, int]:
+    """
+    重新編號新解析區塊的 field / table 名稱,避免與沿用區塊的穩定名稱衝突
+    Returns:
+        下一個可用的 field / table 編號
+    """
+    renamed = {}
+    for field in record["fields"]:
+        new_name = f"field_{next_field}"
+        renamed[field["name"]] = (new_name, field["label"])
+        field["name"] = new_name
+        next_field += 1
+
+    if record["kind"] == "tbl":
+        # 空表格也佔一個編號 (與完整解析的 table_index + 1 一致)
+        base_name = f"table_{next_table}"
+        base_label = f"表格 {next_table}"
+        for table in record["tables"]:
+            if table.get("is_part"):
+                part = table["part_index"] + 1
+                new_name, new_label = f"{base_name}_part_{part}", f"{base_label} ({part})"
+            else:
+                new_name, new_label = base_name, base_label
+            renamed[table["name"]] = (new_name, new_label)
+            table["name"] = new_name
+            table["label"] = new_label
+        next_table += 1
+
+    for item in record["structure"]:
+        if item["type"] in ("field", "table") and item["id"] in renamed:
+            item["id"], item["label"] = renamed[item["id"]]
+    return next_field, next_table
+
+def _assemble_records(records: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """依區塊順序合併,並重新計算段落/表格/圖片索引 (與完整解析的格式與順序相同)"""
+    merged = {"fields": [], "tables": [], "images": [], "structure": [], "paragraphs": []}
+    table_parts = []
+    para_idx = 0
+    table_idx = 0
+    for record in records:
+        if record["kind"] == "p":
+            block_idx = para_idx
+            for para in record["paragraphs"]:
+                para["index"] = para_idx
+            for field in record["fields"]:
+                field["position"]["paragraph_index"] = para_idx
+            for img in record["images"]:
+                if img["paragraph_index"] >= 0:
+                    img["paragraph_index"] = para_idx
+            para_idx += 1
+        else:
+            block_idx = table_idx
+            for table in record["tables"]:
+                table["position"]["table_index"] = table_idx
+            table_idx += 1
+
+        for item in record["structure"]:
+            if "block_index" in item:
+                item["block_index"] = block_idx
+
+        merged["fields"].extend(record["fields"])
+        merged["tables"].extend(t for t in record["tables"] if not t.get("is_part"))
+        table_parts.extend(t for t in record["tables"] if t.get("is_part"))
+        merged["images"].extend(record["images"])
+        merged["structure"].extend(record["structure"])
+        merged["paragraphs"].extend(record["paragraphs"])
+
+    # 與完整解析一致: 分頁切割出的表格附加在所有表格之後
+    merged["tables"].extend(table_parts)
+    for i, img in enumerate(merged["images"]):
+        img["index"] = i
+    return merged
+
+def _record_ids(records: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    return {
+        "structure": [item["id"] for r in records for item in r["structure"]],
+        "fields": [f["name"] for r in records for f in r["fields"]],
+        "tables": [t["name"] for r in records for t in r["tables"]],
+        "images": [img["id"] for r in records for img in r["images"]],
+    }
+
+def _process_docx_diff(file_path: Union[str, IO[bytes]], filename: str, template_id: str = None,
+                       compact: bool = False) -> Dict[str, Any]:
+    """
+    差異解析: 與快取中同一 template_id 的上一次解析比對頂層區塊的內容雜湊
+    - 未變動的區塊沿用上一次的結果與 id (段落 id、field / table 名稱、圖片 URL 皆不變)
+    - 只重新解析 (與上傳圖片) 變動的區塊
+    回傳完整結果 (索引已重新計算),並附上 patch:
+    {"mode": "full" | "patch", "reused_blocks", "reparsed_blocks", "ops": [{op, old, new, removed, added}]}
+    """
+    doc = Document(file_path)
+    if not template_id:
+        template_id = str(uuid.uuid4())
+    with _template_lock(template_id):
+        return _diff_against_cache(doc, filename, template_id, compact)
+
+def _diff_against_cache(doc: Document, filename: str, template_id: str, compact: bool) -> Dict[str, Any]:
+    # 段落內的分節設定會隨未變動區塊一起移除,先擷取
+    sections = extract_section_properties(doc)
+    doc_hash = _doc_level_hash(doc)
+    blocks = _iter_body_blocks(doc)
+    hashes = [_block_hash(doc, block) for block in blocks]
+    with _parse_cache_lock:
+        cached = _parse_cache.get(template_id)
+
+    if cached is None or cached["doc_hash"] != doc_hash:
+        records = _parse_block_records(doc, template_id)
+        patch = {"mode": "full", "reused_blocks": 0, "reparsed_blocks": len(records), "ops": []}
+    else:
+        old_records = cached["records"]
+        matcher = SequenceMatcher(None, [r["hash"] for r in old_records], hashes, autojunk=False)
+        opcodes = matcher.get_opcodes()
+
+        records = [None] * len(blocks)
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal":
+                records[j1:j2] = old_records[i1:i2]
+        changed = [j for j, record in enumerate(records) if record is None]
+
+        if changed:
+            # 移除未變動的區塊,只解析剩下的部分 (區塊在縮減後文件中的順序與 changed 相同)
+            body = doc.element.body
+            changed_set = set(changed)
+            for j, block in enumerate(blocks):
+                if j not in changed_set:
+                    body.remove(block)
+
+            kept = [r for r in records if r is not None]
+            next_field = max((_name_number(f["name"]) for r in kept for f in r["fields"]), default=0) + 1
+            next_table = max((_name_number(t["name"]) for r in kept for t in r["tables"] if not t.get("is_part")), default=0) + 1
+            for j, record in zip(changed, _parse_block_records(doc, template_id)):
+                next_field, next_table = _rename_record(record, next_field, next_table)
+                records[j] = record
+
+        ops = []
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal":
+                continue
+            ops.append({"op": tag, "old": [i1, i2], "new": [j1, j2],
+                        "removed": _record_ids(old_records[i1:i2]), "added": None})
+        patch = {"mode": "patch", "reused_blocks": len(blocks) - len(changed),
+                 "reparsed_blocks": len(changed), "ops": ops}
+
+    for record, block_hash in zip(records, hashes):
+        record["hash"] = block_hash
+    merged = _assemble_records(records)
+
+    # 新增內容在索引重新計算後才填入 patch
+    for op in patch["ops"]:
+        added = records[op["new"][0]:op["new"][1]]
+        op["added"] = {key: [item for r in added for item in r[key]]
+                       for key in ("structure", "paragraphs", "fields", "tables", "images")}
+        if compact:
+            op["added"]["tables"] = [compact_table(t) for t in op["added"]["tables"]]
+
+    # 快取保留獨立的副本: 下一次差異解析會就地改寫沿用區塊的索引,不能動到已回傳 (可能尚未序列化) 的結果
+    cached_records = copy.deepcopy(records)
+    with _parse_cache_lock:
+        _parse_cache[template_id] = {"doc_hash": doc_hash, "records": cached_records}
+        _parse_cache.move_to_end(template_id)
+        while len(_parse_cache) > PARSE_CACHE_SIZE:
+            evicted, _ = _parse_cache.popitem(last=False)
+            _template_locks.pop(evicted, None)
+
+    tables = merged["tables"]
+    if compact:
+        tables = [compact_table(t) for t in tables]
+
+    return {
+        "template_id": template_id,
+        "template_name": filename,
+        "doc_default_size": get_doc_default_size(doc),
+        "sections": sections,
+        "fields": merged["fields"],
+        "tables": tables,
+        "images": merged["images"],
+        "structure": merged["structure"],
+        "paragraphs": merged["paragraphs"],
+        "styles": dict(TEMPLATE_STYLES),
+        "patch": patch
+    }
+
+# ==================== 低記憶體解析 ====================
+
+# 每批放入骨架文件解析的頂層區塊數,以及一批最多同時載入的 media 大小
+LOW_MEMORY_BATCH_BLOCKS = int(os.environ.get("PARSE_LOW_MEMORY_BATCH_BLOCKS", 200))
+LOW_MEMORY_MEDIA_BUDGET = int(os.environ.get("PARSE_LOW_MEMORY_MEDIA_BUDGET_MB", 32)) * 1024 * 1024
+
+W_BODY = qn('w:body')
+W_SECTPR = qn('w:sectPr')
+
+# OPC 套件的關聯與 content type 命名空間 (直接讀 zip 時使用)
+PKG_RELS_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+PKG_CONTENT_TYPES_NS = "http://schemas.openxmlformats.org/package/2006/content-types"
+
+def _main_document_part_name(package: zipfile.ZipFile) -> str:
+    """主文件 part 在 zip 中的名稱 (通常是 word/document.xml)"""
+    root_rels = etree.fromstring(package.read("_rels/.rels"))
+    return next(rel.get("Target") for rel in root_rels.iter(f"{{{PKG_RELS_NS}}}Relationship")
+                if rel.get("Type") == RT.OFFICE_DOCUMENT).lstrip("/")
+
+def _is_binary_member(name: str) -> bool:
+    return not (name.endswith(".xml") or name.endswith(".rels"))
+
+def _build_skeleton_document(package: zipfile.ZipFile, main_part: str, root) -> Document:
+    """
+    骨架文件: 保留樣式、編號、頁首頁尾等 XML part,主文件只有空的 body (沿用原本根元素的命名空間),
+    media / 內嵌字型等二進位 part 以空內容代替 (解析到引用它們的區塊時才讀取,見 _loaded_media)
+    """
+    skeleton_root = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+    etree.SubElement(skeleton_root, W_BODY)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as out:
+        for name in package.namelist():
+            if name == main_part:
+                out.writestr(name, etree.tostring(skeleton_root, xml_declaration=True, encoding="UTF-8", standalone=True))
+            elif _is_binary_member(name):
+                out.writestr(name, b"")
+            else:
+                out.writestr(name, package.read(name))
+    buffer.seek(0)
+    return Document(buffer)
+
+def _block_media_members(doc: Document, block) -> List[str]:
+    """區塊引用的二進位 part 在 zip 中的名稱"""
+    names = []
+    rels = doc.part.rels
+    for rId in XPATH_RELATIONSHIP_IDS(block):
+        rel = rels.get(rId)
+        if rel is None or rel.is_external:
+            continue
+        name = rel.target_part.partname.lstrip("/")
+        if _is_binary_member(name):
+            names.append(name)
+    return names
+
+@contextmanager
+def _loaded_media(doc: Document, package: zipfile.ZipFile, blocks: List):
+    """暫時從 zip 載入這批區塊引用的二進位 part,解析完即釋放"""
+    loaded = []
+    parts = {part.partname.lstrip("/"): part for part in doc.part.related_parts.values()}
+    for block in blocks:
+        for name in _block_media_members(doc, block):
+            part = parts[name]
+            if not part._blob:
+                part._blob = package.read(name)
+                loaded.append(part)
+    try:
+        yield
+    finally:
+        for part in loaded:
+            part._blob = b""
+
+def _process_docx_low_memory(file_path: Union[str, IO[bytes]], filename: str, template_id: str = None,
+                             compact: bool = False, lazy_images: bool = False) -> Dict[str, Any]:
+    """
+    低記憶體模式 (超大型範本): 以 iterparse 串流讀取主文件 XML,每 LOW_MEMORY_BATCH_BLOCKS 個頂層區塊
+    放入骨架文件解析,解析完即從樹中移除;圖片等 media 只在所屬區塊解析時才從 zip 讀取
+    記憶體只保留一批區塊的 XML 與輸出結果,輸出格式與 _process_docx_file 相同
+    """
+    if not template_id:
+        template_id = str(uuid.uuid4())
+
+    records = []
+    section_breaks = []  # 段落內的分節設定 (sectPr)
+    body_sectPr = None
+    next_field = 1
+    next_table = 1
+
+    with zipfile.ZipFile(file_path) as package:
+        main_part = _main_document_part_name(package)
+        doc = None
+        batch = []
+        batch_media = set()
+        batch_media_bytes = 0
+
+        def flush():
+            nonlocal next_field, next_table, batch_media_bytes
+            body = doc.element.body
+            for block in batch:
+                body.append(block)
+            with _loaded_media(doc, package, batch):
+                for record in _parse_block_records(doc, template_id, lazy_images):
+                    next_field, next_table = _rename_record(record, next_field, next_table)
+                    records.append(record)
+            for block in batch:
+                body.remove(block)
+            batch.clear()
+            batch_media.clear()
+            batch_media_bytes = 0
+
+        with package.open(main_part) as stream:
+            context = etree.iterparse(stream, events=("start", "end"), remove_blank_text=True, huge_tree=True)
+            context.set_element_class_lookup(oxml_element_class_lookup)
+            depth = 0
+            for event, elem in context:
+                if event == "start":
+                    depth += 1
+                    if depth == 1:
+                        doc = _build_skeleton_document(package, main_part, elem)
+                    continue
+
+                depth -= 1
+                if depth != 2:
+                    continue
+                # body 的直接子元素已完整讀入: 從串流的樹中移出,解析後即可釋放
+                elem.getparent().remove(elem)
+                if isinstance(elem, (CT_P, CT_Tbl)):
+                    pPr = elem.find(W_PPR)
+                    sectPr = pPr.find(W_SECTPR) if pPr is not None else None
+                    if sectPr is not None:
+                        section_breaks.append(copy.deepcopy(sectPr))
+                    # 引用大型 media 的區塊提早分批,同時載入的 media 不超過 LOW_MEMORY_MEDIA_BUDGET
+                    media = set(_block_media_members(doc, elem)) - batch_media
+                    media_bytes = sum(package.getinfo(name).file_size for name in media)
+                    if batch and media_bytes and batch_media_bytes + media_bytes > LOW_MEMORY_MEDIA_BUDGET:
+                        flush()
+                    batch.append(elem)
+                    batch_media.update(media)
+                    batch_media_bytes += media_bytes
+                    if len(batch) >= LOW_MEMORY_BATCH_BLOCKS:
+                        flush()
+                elif elem.tag == W_SECTPR:
+                    body_sectPr = elem
+            if batch:
+                flush()
+
+    # 分節設定: 以只含 sectPr 的段落重建,再沿用 extract_section_properties
+    body = doc.element.body
+    for sectPr in section_breaks:
+        p = OxmlElement('w:p')
+        p.append(OxmlElement('w:pPr'))
+        p[0].append(sectPr)
+        body.append(p)
+    if body_sectPr is not None:
+        body.append(body_sectPr)
+    sections = extract_section_properties(doc)
+
+    merged = _assemble_records(records)
+    tables = merged["tables"]
+    if compact:
+        tables = [compact_table(t) for t in tables]
+
+    return {
+        "template_id": template_id,
+        "template_name": filename,
+        "doc_default_size": get_doc_default_size(doc),
+        "sections": sections,
+        "fields": merged["fields"],
+        "tables": tables,
+        "images": merged["images"],
+        "structure": merged["structure"],
+        "paragraphs": merged["paragraphs"],
+        "styles": dict(TEMPLATE_STYLES)
+    }
+
+# ==================== 解析排程 ====================
+
+# 同時執行的解析數 (thread pool 大小) 與排隊上限,超過上限直接回 503
+PARSE_CONCURRENCY = int(os.environ.get("PARSE_CONCURRENCY", 4))
+PARSE_MAX_QUEUE = int(os.environ.get("PARSE_MAX_QUEUE", 32))
+
+class ParseScheduler:
+    """
+    將阻塞的解析 (python-docx + 同步的 Supabase 上傳) 交給有上限的 thread pool,
+    event loop 只負責 I/O,/health 與其他請求不會被大型範本卡住
+    """
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="parse")
+
+    def _submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            if self.running + self.queued >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise HTTPException(status_code=503, detail="Parse queue is full, retry later",
+                                    headers={"Retry-After": "5"})
+            self.queued += 1
+
+        def job():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        future = self._executor.submit(job)
+        future.add_done_callback(self._release_if_cancelled)
+        return future
+
+    def _release_if_cancelled(self, future: Future):
+        # 排隊中被取消 (請求被取消或用戶端中斷) 時 job() 不會執行,由此歸還名額
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        return await asyncio.wrap_future(self._submit(fn, *args, **kwargs))
+
+    async def run_stream(self, fn: Callable, *args, **kwargs) -> "_ReleasingIterator":
+        """
+        fn 回傳 generator (串流輸出): 圖片上傳、表格解析等在迭代時才執行,
+        因此 job 會一直佔住名額,直到 generator 耗盡或關閉才釋放
+        """
+        handoff: Future = Future()
+        pending = [handoff]
+        released = threading.Event()
+
+        def hold():
+            # 不在 closure 中保留 handoff: 交出的 iterator 沒人引用時才能經由 __del__ 釋放名額
+            future = pending.pop()
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                records = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            future.set_result(_ReleasingIterator(records, released.set))
+            del future
+            released.wait()
+
+        self._submit(hold)
+        try:
+            return await asyncio.wrap_future(handoff)
+        except asyncio.CancelledError:
+            # 等待期間請求被取消: 之後交出的 generator 不會有人迭代,直接關閉
+            handoff.add_done_callback(lambda f: f.cancelled() or f.exception() or f.result().close())
+            raise
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "running": self.running,
+                "queued": self.queued,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "max_concurrency": self.max_workers,
+                "max_queue": self.max_queue
+            }
+
+class _ReleasingIterator:
+    """包裝串流輸出的 generator: 耗盡、發生錯誤或關閉時釋放 ParseScheduler 的名額 (可重複關閉)"""
+    def __init__(self, records: Iterator, release: Callable[[], None]):
+        self._records = records
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._records)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is None:
+            return
+        try:
+            self._records.close()
+        except ValueError:
+            pass  # 用戶端中斷時另一個執行緒可能仍在迭代,generator 之後由 GC 關閉
+        finally:
+            release()
+
+    def __del__(self):
+        # 用戶端中斷連線時 StreamingResponse 不會執行 background,由 GC 釋放
+        self.close()
+
+parse_scheduler = ParseScheduler(PARSE_CONCURRENCY, PARSE_MAX_QUEUE)
 
 # ==================== API 端點 ====================
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "template-parsing-v2.2 (pict-support)"}
+    return {
+        "status": "healthy",
+        "service": "template-parsing-v2.2 (pict-support)",
+        "parse_queue": parse_scheduler.stats()
+    }
 
 class ParseRequest(BaseModel):
     file_path: str
     bucket: str = "raw-files"
     template_id: Optional[str] = None
+    parallel: bool = False
+    stream: bool = False
+    compact: bool = False
+    diff: bool = False
+    lazy_images: bool = False
+    low_memory: bool = False
+
+def check_parse_modes(parallel: bool = False, stream: bool = False, diff: bool = False, low_memory: bool = False,
+                      lazy_images: bool = False, profile: bool = False):
+    """
+    diff / low_memory / stream 互斥,且都不支援 parallel 與 profile;diff 另不支援 lazy_images
+    (沿用的區塊已上傳圖片)。不支援的組合回 400,不默默忽略
+    """
+    modes = [name for name, enabled in (("diff", diff), ("low_memory", low_memory), ("stream", stream)) if enabled]
+    if len(modes) > 1:
+        raise HTTPException(status_code=400, detail=f"{' and '.join(modes)} cannot be combined")
+    if not modes:
+        return
+    unsupported = [name for name, enabled in (("parallel", parallel), ("profile", profile),
+                                             ("lazy_images", diff and lazy_images)) if enabled]
+    if unsupported:
+        raise HTTPException(status_code=400, detail=f"{modes[0]} does not support {', '.join(unsupported)}")
 
 # 共用的解析邏輯
-def _process_docx_file(file_path: str, filename: str, template_id: str = None) -> Dict[str, Any]:
+def _process_docx_file(file_path: Union[str, IO[bytes]], filename: str, template_id: str = None, parallel: bool = False,
+                       compact: bool = False, profiler: Optional[ParseProfiler] = None,
+                       lazy_images: bool = False) -> Dict[str, Any]:
+    """
+    parallel: 將頂層區塊分配到 process pool 平行解析 (適用於上千頁的大型範本)
+    lazy_images: 圖片只記錄描述不上傳 (只需要大綱時使用,見 extract_images_from_doc)
+    compact: 表格以精簡格式輸出 (見 compact_table)
+    profiler: 記錄各階段耗時與元素數量 (見 ParseProfiler)
+    """
     try:
-        doc = Document(file_path)
+        if profiler is not None:
+            profiler.start()
+
+        with _stage(profiler, "load_document"):
+            doc = Document(file_path)
         if not template_id:
             template_id = str(uuid.uuid4())
+        if profiler is not None:
+            profiler.count_elements(doc)
         
-        sections = extract_section_properties(doc)
-        images = extract_images_from_doc(doc, template_id) # Extract images first
-        fields = detect_fillable_fields(doc)
+        with _stage(profiler, "extract_section_properties"):
+            sections = extract_section_properties(doc)
+        with _stage(profiler, "extract_images_from_doc"):
+            images = extract_images_from_doc(doc, template_id, profiler, lazy=lazy_images) # Extract images first
+        with _stage(profiler, "detect_fillable_fields"):
+            fields = detect_fillable_fields(doc)
         
-        # Pass images to table detection
-        tables = detect_fillable_tables(doc, images) 
-        
-        # 4. 建立線性結構
-        structure, paragraphs = build_document_structure(doc, fields, tables, images)
+        if parallel:
+            with _stage(profiler, "parse_blocks_parallel"):
+                tables, structure, paragraphs = parse_blocks_parallel(doc, fields, images)
+        else:
+            # Pass images to table detection
+            with _stage(profiler, "detect_fillable_tables"):
+                tables = detect_fillable_tables(doc, images) 
+            
+            # 4. 建立線性結構
+            with _stage(profiler, "build_document_structure"):
+                structure, paragraphs = build_document_structure(doc, fields, tables, images)
 
-        # Cleanup internal objects before serialization
         # Cleanup internal objects before serialization
         for img in images:
             img.pop('_parent_elem', None)
-        
-        # Extract default font size
-        doc_default_size = None
-        try:
-            doc_defaults = doc.styles.element.find(qn('w:docDefaults'))
-            if doc_defaults is not None:
-                rPrDefault = doc_defaults.find(qn('w:rPrDefault'))
-                if rPrDefault is not None:
-                    rPr = rPrDefault.find(qn('w:rPr'))
-                    if rPr is not None:
-                        sz = rPr.find(qn('w:sz'))
-                        if sz is not None:
-                             doc_default_size = int(sz.get(qn('w:val'))) / 2.0
-        except Exception:
-            pass
+
+        if compact:
+            with _stage(profiler, "compact_tables"):
+                tables = [compact_table(t) for t in tables]
+
+        if profiler is not None:
+            profiler.stop()
 
         return {
             "template_id": template_id,
             "template_name": filename,
-            "doc_default_size": doc_default_size,
+            "doc_default_size": get_doc_default_size(doc),
             "sections": sections,
             "fields": fields,
             "tables": tables,
             "images": images,
             "structure": structure, 
             "paragraphs": paragraphs, # New Field
-            "styles": {
-                "default_font": "微軟正黑體",
-                "default_size": 12,
-                "note": "Enhanced python-docx extraction (v2) with Images & Structure"
-            }
+            "styles": dict(TEMPLATE_STYLES)
         }
     except Exception as e:
         raise e
 
+def get_doc_default_size(doc: Document) -> Optional[float]:
+    """Extract default font size (docDefaults -> rPrDefault -> sz)"""
+    try:
+        doc_defaults = doc.styles.element.find(qn('w:docDefaults'))
+        if doc_defaults is not None:
+            rPrDefault = doc_defaults.find(qn('w:rPrDefault'))
+            if rPrDefault is not None:
+                rPr = rPrDefault.find(qn('w:rPr'))
+                if rPr is not None:
+                    sz = rPr.find(qn('w:sz'))
+                    if sz is not None:
+                         return int(sz.get(qn('w:val'))) / 2.0
+    except Exception:
+        pass
+    return None
+
+# ==================== 串流輸出 (NDJSON) ====================
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def iter_template_records(doc: Document, filename: str, template_id: str, compact: bool = False,
+                          lazy_images: bool = False) -> Iterator[Dict[str, Any]]:
+    """
+    逐步產生解析結果,每筆為 {"type": ..., "data": ...}
+    順序: meta -> section* -> image* -> field* -> (table | paragraph | structure)* -> end
+    表格在結構走訪到時才解析,被引用的 table/paragraph 一定在對應的 structure 之前輸出
+    """
+    yield {"type": "meta", "data": {
+        "template_id": template_id,
+        "template_name": filename,
+        "doc_default_size": get_doc_default_size(doc),
+        "styles": dict(TEMPLATE_STYLES)
+    }}
+    for section in extract_section_properties(doc):
+        yield {"type": "section", "data": section}
+
+    images = extract_images_from_doc(doc, template_id, lazy=lazy_images)
+    for img in images:
+        img.pop('_parent_elem', None)
+        yield {"type": "image", "data": img}
+
+    fields = detect_fillable_fields(doc)
+    for field in fields:
+        yield {"type": "field", "data": field}
+
+    built_tables = []
+    def resolve_table(table_idx, tbl):
+        table_data = extract_table(Table(tbl, doc._body), table_idx, images)
+        if table_data is not None:
+            built_tables.append(table_data)
+        return table_data
+
+    counts = {"tables": 0, "paragraphs": 0, "structure": 0}
+    for structure, paragraphs, table_parts in iter_document_structure(doc, fields, images, resolve_table):
+        for table_data in built_tables + table_parts:
+            yield {"type": "table", "data": compact_table(table_data) if compact else table_data}
+        counts["tables"] += len(built_tables) + len(table_parts)
+        built_tables.clear()
+
+        for para in paragraphs:
+            yield {"type": "paragraph", "data": para}
+        for item in structure:
+            yield {"type": "structure", "data": item}
+        counts["paragraphs"] += len(paragraphs)
+        counts["structure"] += len(structure)
+
+    yield {"type": "end", "data": {
+        "sections": len(doc.sections),
+        "images": len(images),
+        "fields": len(fields),
+        **counts
+    }}
+
+def _stream_docx_file(file_path: Union[str, IO[bytes]], filename: str, template_id: str = None, compact: bool = False,
+                      lazy_images: bool = False) -> Iterator[bytes]:
+    """
+    立即載入文件 (錯誤在回應開始前拋出,且上傳的檔案物件關閉後仍可繼續輸出),回傳逐行 NDJSON 的產生器
+    """
+    doc = Document(file_path)
+    if not template_id:
+        template_id = str(uuid.uuid4())
+
+    def generate():
+        for record in iter_template_records(doc, filename, template_id, compact, lazy_images):
+            yield (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+    return generate()
+
 @app.post("/parse-template")
-async def parse_template(file: UploadFile = File(...)):
+async def parse_template(file: UploadFile = File(...), parallel: bool = False, stream: bool = False,
+                         compact: bool = False, profile: bool = False, profile_dump: bool = False,
+                         diff: bool = False, template_id: Optional[str] = None, lazy_images: bool = False,
+                         low_memory: bool = False):
     """
     解析 Word 範本 (直接上傳檔案)
+    parallel=true 時以多核心平行解析
+    stream=true 時以 NDJSON 逐筆串流輸出 (見 iter_template_records)
+    compact=true 時表格以精簡格式輸出 (見 compact_table)
+    profile=true 時在結果附上 profile (各階段耗時與元素數量),profile_dump=true 另產生 cProfile dump
+    diff=true 時與同一 template_id 的上一次解析比對,只重新解析變動的區塊並附上 patch (見 _process_docx_diff)
+    lazy_images=true 時圖片不上傳,只回傳描述 (url 之後由 /materialize-images 產生)
+    low_memory=true 時以串流方式分批解析超大型範本 (見 _process_docx_low_memory)
     """
     try:
-        temp_path = f"/tmp/{file.filename}"
-        with open(temp_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-        
-        try:
-            result = _process_docx_file(temp_path, file.filename)
-            return JSONResponse(result)
-        finally:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+        check_parse_modes(parallel, stream, diff, low_memory, lazy_images, profile or profile_dump)
+
+        # 直接從上傳的 SpooledTemporaryFile 解析 (小檔在記憶體中,大檔由 starlette 自動轉存),不另寫 /tmp
+        await file.seek(0)
+        source = file.file
+
+        if diff:
+            return JSONResponse(await parse_scheduler.run(_process_docx_diff, source, file.filename, template_id, compact))
+        if low_memory:
+            return JSONResponse(await parse_scheduler.run(
+                _process_docx_low_memory, source, file.filename, template_id, compact, lazy_images))
+        if stream:
+            records = await parse_scheduler.run_stream(
+                _stream_docx_file, source, file.filename, template_id, compact, lazy_images)
+            return StreamingResponse(records, media_type=NDJSON_MEDIA_TYPE, background=BackgroundTask(records.close))
+        profiler = ParseProfiler(cprofile=profile_dump) if (profile or profile_dump) else None
+        result = await parse_scheduler.run(_process_docx_file, source, file.filename, template_id, parallel=parallel,
+                                           compact=compact, profiler=profiler, lazy_images=lazy_images)
+        if profiler is not None:
+            # 寫入 .prof 與 pstats 排序可能需要數百毫秒,不在 event loop 上執行
+            result["profile"] = await run_in_threadpool(profiler.report, result["template_id"])
+        return JSONResponse(result)
         
+    except HTTPException as he:
+        raise he
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1373,6 +2622,8 @@ async def parse_from_supabase(request: ParseRequest):
     從 Supabase Storage 下載並解析 Word 範本
     """
     try:
+        check_parse_modes(request.parallel, request.stream, request.diff, request.low_memory, request.lazy_images)
+
         supabase_url = os.environ.get("SUPABASE_URL")
         supabase_key = os.environ.get("SUPABASE_SERVICE_KEY")
         
@@ -1388,27 +2639,220 @@ async def parse_from_supabase(request: ParseRequest):
         print(f"Downloading {file_path} from bucket {bucket}...")
         
         try:
-            response = supabase.storage.from_(bucket).download(file_path)
+            # supabase-py 為同步 client,下載交給 thread pool 以免卡住 event loop
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: supabase.storage.from_(bucket).download(file_path)
+            )
             # response is bytes in newer supabase-py versions, or handle checks
         except Exception as e:
             print(f"Failed to download from Supabase: {e}")
             raise HTTPException(status_code=400, detail=f"Failed to download file: {str(e)}")
 
-        # 寫入暫存檔
+        # 直接從記憶體中的 bytes 解析,不寫暫存檔
         filename = os.path.basename(file_path)
-        temp_path = f"/tmp/{uuid.uuid4()}_{filename}"
-        
-        with open(temp_path, "wb") as f:
-            f.write(response)
-            
+        source = io.BytesIO(response)
+
+        if request.diff:
+            return JSONResponse(await parse_scheduler.run(
+                _process_docx_diff, source, filename, request.template_id, request.compact))
+        if request.low_memory:
+            return JSONResponse(await parse_scheduler.run(
+                _process_docx_low_memory, source, filename, request.template_id, request.compact, request.lazy_images))
+        if request.stream:
+            records = await parse_scheduler.run_stream(
+                _stream_docx_file, source, filename, request.template_id, request.compact, request.lazy_images)
+            return StreamingResponse(records, media_type=NDJSON_MEDIA_TYPE, background=BackgroundTask(records.close))
+        # 使用傳入的 template_id (若有)，否則 _process_docx_file 會生成
+        result = await parse_scheduler.run(_process_docx_file, source, filename, request.template_id, request.parallel,
+                                           request.compact, lazy_images=request.lazy_images)
+        return JSONResponse(result)
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== 批次解析 ====================
+
+# 批次上限與同時下載數
+MAX_BATCH_SIZE = int(os.environ.get("PARSE_BATCH_MAX_SIZE", 100))
+BATCH_DOWNLOAD_CONCURRENCY = int(os.environ.get("PARSE_BATCH_DOWNLOAD_CONCURRENCY", 8))
+
+class BatchParseRequest(BaseModel):
+    file_paths: List[str]
+    bucket: str = "raw-files"
+    compact: bool = False
+
+def _parse_batch_item(data: bytes, filename: str, compact: bool) -> Dict[str, Any]:
+    """Worker: 在 process pool 中解析單一範本,回傳結果與解析時間"""
+    start = time.perf_counter()
+    result = _process_docx_file(io.BytesIO(data), filename, compact=compact)
+    return {"result": result, "parse_seconds": time.perf_counter() - start}
+
+@app.post("/parse-batch")
+async def parse_batch(request: BatchParseRequest):
+    """
+    批次匯入範本: 並行下載多個檔案,並在 process pool 中平行解析
+    單一檔案失敗不影響其他檔案,回傳每個範本的結果與整體耗時
+    """
+    if not request.file_paths:
+        raise HTTPException(status_code=400, detail="file_paths is empty")
+    if len(request.file_paths) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Too many files: {len(request.file_paths)} > {MAX_BATCH_SIZE}")
+
+    supabase_url = os.environ.get("SUPABASE_URL")
+    supabase_key = os.environ.get("SUPABASE_SERVICE_KEY")
+    if not supabase_url or not supabase_key:
+        raise HTTPException(status_code=500, detail="Supabase credentials missing")
+
+    supabase: Client = create_client(supabase_url, supabase_key)
+    loop = asyncio.get_running_loop()
+    download_semaphore = asyncio.Semaphore(BATCH_DOWNLOAD_CONCURRENCY)
+    batch_start = time.perf_counter()
+
+    async def process_one(file_path: str) -> Dict[str, Any]:
+        item = {"file_path": file_path, "status": "error"}
         try:
-            # 使用傳入的 template_id (若有)，否則 _process_docx_file 會生成
-            result = _process_docx_file(temp_path, filename, request.template_id)
-            return JSONResponse(result)
-        finally:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            # 1. 下載 (supabase-py 為同步 client,交給 thread pool)
+            start = time.perf_counter()
+            async with download_semaphore:
+                data = await loop.run_in_executor(
+                    None, lambda: supabase.storage.from_(request.bucket).download(file_path)
+                )
+            item["download_seconds"] = round(time.perf_counter() - start, 3)
+
+            # 2. 下載完成即送入 process pool 解析,與其他檔案的下載重疊進行
+            #    (每次重新取得 pool: 前一個檔案弄壞 pool 後,之後的檔案改送新的 pool)
+            pool = _get_process_pool()
+            try:
+                parsed = await asyncio.wrap_future(
+                    pool.submit(_parse_batch_item, data, os.path.basename(file_path), request.compact)
+                )
+            except BrokenProcessPool:
+                _discard_process_pool(pool)
+                raise
+            item["parse_seconds"] = round(parsed["parse_seconds"], 3)
+            item["status"] = "success"
+            item["result"] = parsed["result"]
+        except Exception as e:
+            print(f"Batch parse failed for {file_path}: {e}")
+            item["error"] = str(e)
+        return item
+
+    results = await asyncio.gather(*(process_one(path) for path in request.file_paths))
+
+    succeeded = sum(1 for r in results if r["status"] == "success")
+    return JSONResponse({
+        "results": results,
+        "summary": {
+            "total": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "download_seconds": round(sum(r.get("download_seconds", 0) for r in results), 3),
+            "parse_seconds": round(sum(r.get("parse_seconds", 0) for r in results), 3),
+            "wall_seconds": round(time.perf_counter() - batch_start, 3),
+            "workers": PARSE_WORKERS
+        }
+    })
+
+# ==================== 圖片延遲上傳 ====================
+
+class MaterializeImagesRequest(BaseModel):
+    file_path: str
+    template_id: str
+    bucket: str = "raw-files"
+    rIds: Optional[List[str]] = None  # None: 主文件引用的所有圖片
+
+def read_document_media(data: bytes, rIds: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    直接從 zip 讀取主文件引用的圖片 part (只讀關聯與需要的 media 成員,不解析 document.xml)
+    Returns:
+        [{"rId", "content_type", "blob"}]
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as package:
+        main_part = _main_document_part_name(package)
+        base_dir = posixpath.dirname(main_part)
+        rels_name = posixpath.join(base_dir, "_rels", posixpath.basename(main_part) + ".rels")
+
+        # 與 python-docx 相同: Override (依 part 名稱) 優先於 Default (依副檔名)
+        content_types = etree.fromstring(package.read("[Content_Types].xml"))
+        defaults = {e.get("Extension").lower(): e.get("ContentType")
+                    for e in content_types.iter(f"{{{PKG_CONTENT_TYPES_NS}}}Default")}
+        overrides = {e.get("PartName"): e.get("ContentType")
+                     for e in content_types.iter(f"{{{PKG_CONTENT_TYPES_NS}}}Override")}
+
+        wanted = set(rIds) if rIds is not None else None
+        media = []
+        for rel in etree.fromstring(package.read(rels_name)).iter(f"{{{PKG_RELS_NS}}}Relationship"):
+            rId = rel.get("Id")
+            if rel.get("Type") != RT.IMAGE or rel.get("TargetMode") == "External":
+                continue
+            if wanted is not None and rId not in wanted:
+                continue
+            target = rel.get("Target")
+            part_name = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(base_dir, target))
+            ext = posixpath.splitext(part_name)[1][1:].lower()
+            media.append({
+                "rId": rId,
+                "content_type": overrides.get("/" + part_name) or defaults.get(ext, "application/octet-stream"),
+                "blob": package.read(part_name)
+            })
+    return media
 
+def _materialize_media(supabase: Client, data: bytes, template_id: str, rIds: Optional[List[str]]) -> List[Dict[str, Any]]:
+    """上傳範本中指定的圖片 (相同內容只上傳一次),回傳各圖片的 URL"""
+    uploaded = {}
+    images = []
+    for item in read_document_media(data, rIds):
+        content_hash = hashlib.sha256(item["blob"]).hexdigest()
+        if content_hash not in uploaded:
+            content_type = item["content_type"]
+            ext = content_type.split('/')[-1] if '/' in content_type else 'png'
+            path = f"template_assets/{template_id}/{content_hash}.{ext}"
+            supabase.storage.from_(IMAGE_BUCKET).upload(path, item["blob"], {
+                "content-type": content_type,
+                "upsert": "true"
+            })
+            uploaded[content_hash] = {
+                "url": supabase.storage.from_(IMAGE_BUCKET).get_public_url(path),
+                "variants": upload_image_variants(supabase, path, item["blob"]) if IMAGE_VARIANTS else None
+            }
+        image = {
+            "rId": item["rId"],
+            "content_hash": content_hash,
+            "content_type": item["content_type"],
+            "size_bytes": len(item["blob"]),
+            "url": uploaded[content_hash]["url"]
+        }
+        if IMAGE_VARIANTS:
+            image["variants"] = uploaded[content_hash]["variants"]
+        images.append(image)
+    return images
+
+@app.post("/materialize-images")
+async def materialize_images(request: MaterializeImagesRequest):
+    """
+    為 lazy_images 解析的圖片產生 URL: 重新下載範本,只讀取需要的圖片並上傳
+    以內容雜湊命名 (template_assets/{template_id}/{content_hash}.{ext}),重複呼叫或相同圖片不會產生重複檔案
+    """
+    supabase_url = os.environ.get("SUPABASE_URL")
+    supabase_key = os.environ.get("SUPABASE_SERVICE_KEY")
+    if not supabase_url or not supabase_key:
+        raise HTTPException(status_code=500, detail="Supabase credentials missing")
+
+    supabase: Client = create_client(supabase_url, supabase_key)
+    try:
+        data = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: supabase.storage.from_(request.bucket).download(request.file_path)
+        )
+    except Exception as e:
+        print(f"Failed to download from Supabase: {e}")
+        raise HTTPException(status_code=400, detail=f"Failed to download file: {str(e)}")
+
+    try:
+        images = await parse_scheduler.run(_materialize_media, supabase, data, request.template_id, request.rIds)
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -1416,6 +2860,13 @@ async def parse_from_supabase(request: ParseRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+    found = {img["rId"] for img in images}
+    return JSONResponse({
+        "template_id": request.template_id,
+        "images": images,
+        "missing": [rId for rId in (request.rIds or []) if rId not in found]
+    })
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8004)
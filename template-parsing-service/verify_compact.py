@@ -0,0 +1,53 @@
+
+import sys
+import json
+import docx
+
+sys.path.append("/app")
+
+try:
+    from service import detect_fillable_tables, compact_table, expand_compact_table
+except ImportError as e:
+    print(f"Import Error: {e}")
+    sys.exit(1)
+
+def _normalize_runs(table):
+    # 段落間的換行 run 帶有 "type": "text",精簡格式不保留 (前端預設即為文字)
+    for cell in table['cells']:
+        for run in cell['runs']:
+            if run.get('type') == 'text':
+                del run['type']
+    return table
+
+def verify_compact(file_path):
+    print(f"Verifying Compact Encoding for: {file_path}")
+    doc = docx.Document(file_path)
+    tables = detect_fillable_tables(doc)
+
+    print("\n--- Round Trip & Size Verification ---")
+    total_full = 0
+    total_compact = 0
+    failures = 0
+    for tbl in tables:
+        compact = compact_table(tbl)
+        full_size = len(json.dumps(tbl, ensure_ascii=False))
+        compact_size = len(json.dumps(compact, ensure_ascii=False))
+        total_full += full_size
+        total_compact += compact_size
+
+        expanded = expand_compact_table(compact)
+        if _normalize_runs(expanded) != _normalize_runs(json.loads(json.dumps(tbl))):
+            failures += 1
+            print(f"  {tbl['name']}: FAILURE (round trip mismatch)")
+            continue
+
+        print(f"  {tbl['name']}: {len(tbl['cells'])} cells, "
+              f"{len(compact['cellFormats'])} cell formats, {len(compact['runFormats'])} run formats, "
+              f"{full_size} -> {compact_size} bytes")
+
+    if total_compact:
+        print(f"\nTotal: {total_full} -> {total_compact} bytes ({total_full / total_compact:.1f}x smaller)")
+    print("SUCCESS: Compact encoding round trips." if failures == 0 else f"FAILURE: {failures} table(s) mismatch.")
+
+if __name__ == "__main__":
+    verify_compact(sys.argv[1] if len(sys.argv) > 1 else "/app/test_doc.docx")